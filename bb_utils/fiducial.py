@@ -1,6 +1,8 @@
 import numpy as np
 import matplotlib.pyplot as plt
 
+from bb_utils.timestamps import to_naive_utc_datetime64
+
 def plot_marker(ax, inverse=False):
     """Plots a marker to an existing pyplot axis.
 
@@ -93,144 +95,633 @@ def get_marker(load=True, **kwargs):
 
     return marker
 
-def locate_markers(image, markersize, n_markers, marker=None, rescale="auto", pad_borders=True):
+def _fft_shape(image_shape, kernel_shapes):
+    """Returns a fast FFT size that is large enough for the linear convolution of the image with
+    each kernel."""
+    import scipy.fft
+
+    sizes = [image_shape[axis] + max(shape[axis] for shape in kernel_shapes) - 1
+             for axis in range(2)]
+    return tuple(scipy.fft.next_fast_len(size, real=True) for size in sizes)
+
+class MarkerTemplateBank:
+    """Resized and rotated variants of a marker that are used as templates by locate_markers.
+        The templates and their Fourier transforms (per FFT size) are computed once and reused,
+        so one bank can be shared by all calls for images with the same marker size.
+        Banks can be pickled for worker processes; the cached transforms are not pickled.
+
+        Arguments:
+            markersize: Size of the templates in pixels, i.e. the marker size in the (rescaled)
+                        image.
+            marker: (optional) numpy array; marker template. Will be loaded with get_marker() if
+                    not given.
+            scale_steps: Number of template sizes around markersize.
+            scale_step: Size difference in pixels between two template sizes.
+            rotation_steps: Number of template rotations.
+            max_rotation: Templates are rotated between -max_rotation and +max_rotation degrees.
+    """
+    # Maximum number of FFT sizes for which the template transforms are kept.
+    max_cached_shapes = 4
+
+    def __init__(self, markersize, marker=None, scale_steps=3, scale_step=2, rotation_steps=3,
+                 max_rotation=5.0):
+        import skimage.transform
+
+        if marker is None:
+            marker = get_marker()
+        self.markersize = int(markersize)
+        self.scale_steps = scale_steps
+        self.scale_step = scale_step
+        self.rotation_steps = rotation_steps
+        self.max_rotation = max_rotation
+
+        # Normalize marker to [-1, 1].
+        marker = marker.astype(np.float32)
+        marker = marker - marker.min()
+        marker /= marker.max()
+        marker = (marker - 0.5) * 2.0
+        self.marker = marker
+
+        self.templates = []
+        for step in range(scale_steps):
+            s = (step - scale_steps // 2) * scale_step
+            resized = skimage.transform.resize(marker, (self.markersize + s, self.markersize + s))
+            for r in np.linspace(-max_rotation, +max_rotation, num=rotation_steps):
+                if r == 0.0:
+                    rotated = resized
+                else:
+                    rotated = skimage.transform.rotate(image=resized, angle=r, resize=True)
+                self.templates.append(rotated.astype(np.float32))
+        # Index of the template with the nominal size and without rotation.
+        self.nominal_index = (scale_steps // 2) * rotation_steps + rotation_steps // 2
+        self._fft_cache = {}
+        self._coarse_banks = {}
+
+    def __len__(self):
+        return len(self.templates)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_fft_cache"] = {}
+        return state
+
+    def coarse_bank(self, markersize):
+        """Returns a bank with the same marker for a coarse pyramid level, i.e. a small markersize.
+            Coarse banks use a single rotation and are cached.
+        """
+        if markersize not in self._coarse_banks:
+            self._coarse_banks[markersize] = MarkerTemplateBank(
+                markersize, marker=self.marker, scale_steps=3, scale_step=1, rotation_steps=1)
+        return self._coarse_banks[markersize]
+
+    def template_ffts(self, fft_shape):
+        """Returns the real FFTs of all templates zero-padded to fft_shape."""
+        import scipy.fft
+
+        fft_shape = tuple(fft_shape)
+        template_ffts = self._fft_cache.get(fft_shape)
+        if template_ffts is None:
+            # Banks can be shared between threads, so evict without assuming that the keys still
+            # exist.
+            nb_evict = max(len(self._fft_cache) - self.max_cached_shapes + 1, 0)
+            for key in list(self._fft_cache)[:nb_evict]:
+                self._fft_cache.pop(key, None)
+            template_ffts = [scipy.fft.rfft2(t, s=fft_shape) for t in self.templates]
+            self._fft_cache[fft_shape] = template_ffts
+        return template_ffts
+
+def _make_template_bank(markersize, marker=None, coarse_to_fine=False):
+    """Returns the default MarkerTemplateBank used by locate_markers for the rescaled markersize."""
+    if coarse_to_fine:
+        return MarkerTemplateBank(markersize, marker=marker, scale_steps=5, scale_step=1,
+                                  rotation_steps=5)
+    return MarkerTemplateBank(markersize, marker=marker)
+
+def _template_response(image, bank, indices=None, response=None):
+    """Convolves the image with every template of the bank and returns the maximum squared
+        response per pixel. The image is transformed once and the transform is reused for all
+        templates. The output is aligned like scipy.signal.convolve2d(image, template, mode="same").
+        indices optionally restricts the templates; the maximum is then accumulated into response
+        if given.
+    """
+    import scipy.fft
+
+    image = image.astype(np.float32)
+    fft_shape = _fft_shape(image.shape, [t.shape for t in bank.templates])
+    image_fft = scipy.fft.rfft2(image, s=fft_shape)
+    h, w = image.shape
+    template_ffts = bank.template_ffts(fft_shape)
+    if indices is None:
+        indices = range(len(bank))
+    for idx in indices:
+        template, template_fft = bank.templates[idx], template_ffts[idx]
+        full = scipy.fft.irfft2(image_fft * template_fft, s=fft_shape)
+        y0, x0 = (template.shape[0] - 1) // 2, (template.shape[1] - 1) // 2
+        conv = full[y0:(y0 + h), x0:(x0 + w)]
+        # The response of the inverse marker is the negative response of the marker,
+        # so |conv| * |-conv| is just the squared response.
+        conv = conv * conv
+        if response is None:
+            response = conv
+        else:
+            np.maximum(response, conv, out=response)
+    return response
+
+class MarkerNotFound(ValueError):
+    """Raised by locate_markers if no marker candidate exceeds the confidence thresholds.
+
+        Attributes:
+            reason: Description of the failed check.
+            confidence: Best normalized cross-correlation of any candidate.
+    """
+    def __init__(self, reason, confidence):
+        super().__init__("{} (best confidence {:.3f}).".format(reason, confidence))
+        self.reason = reason
+        self.confidence = confidence
+
+    def __reduce__(self):
+        return (MarkerNotFound, (self.reason, self.confidence))
+
+def _ncc(image, templates, x, y):
+    """Returns the normalized cross-correlation in [-1, 1] of the image patch at (x, y) with the
+        templates, aligned like _template_response. Inverse markers have a negative correlation.
+        The value with the largest magnitude over all templates is returned.
+        image should be the search image without padding and contrast equalization (which
+        amplifies the noise of flat regions); candidates outside of it have a correlation of 0.
+    """
+    best = 0.0
+    if not (0 <= x < image.shape[1] and 0 <= y < image.shape[0]):
+        return best
+    for template in templates:
+        kh, kw = template.shape
+        # The convolution correlates the flipped template with the patch ending at
+        # (y + k // 2, x + k // 2).
+        y1, x1 = y + (kh - 1) // 2 - kh + 1, x + (kw - 1) // 2 - kw + 1
+        # Only use the part of the template that overlaps the image.
+        ty1, tx1 = max(-y1, 0), max(-x1, 0)
+        ty2, tx2 = min(image.shape[0] - y1, kh), min(image.shape[1] - x1, kw)
+        if ty2 - ty1 < 2 or tx2 - tx1 < 2:
+            continue
+        patch = image[(y1 + ty1):(y1 + ty2), (x1 + tx1):(x1 + tx2)]
+        patch = patch - patch.mean()
+        template = template[::-1, ::-1][ty1:ty2, tx1:tx2]
+        template = template - template.mean()
+        norm = np.sqrt(np.sum(patch * patch) * np.sum(template * template))
+        if norm > 0.0:
+            ncc = float(np.sum(patch * template) / norm)
+            if abs(ncc) > abs(best):
+                best = ncc
+    return best
+
+def _psr(response, x, y, markersize):
+    """Returns the peak-to-sidelobe ratio of the response at (x, y): The peak's distance to the
+        mean of the surrounding region in standard deviations. The main lobe (a quarter marker size
+        around the peak) is excluded.
+    """
+    response = np.sqrt(response)
+    h, w = response.shape
+    y1, y2 = max(y - markersize, 0), min(y + markersize + 1, h)
+    x1, x2 = max(x - markersize, 0), min(x + markersize + 1, w)
+    yy, xx = np.mgrid[y1:y2, x1:x2]
+    sidelobe = response[y1:y2, x1:x2][np.maximum(np.abs(yy - y), np.abs(xx - x)) > markersize // 4]
+    std = sidelobe.std()
+    if std == 0.0:
+        return 0.0
+    return float((response[y, x] - sidelobe.mean()) / std)
+
+def _check_candidates(image, templates, peaks, padding, min_confidence, reason):
+    """Raises MarkerNotFound if the correlation at none of the (y, x) peaks exceeds
+    min_confidence. The peaks are given in the image padded by padding pixels."""
+    nccs = [_ncc(image, templates, x - padding, y - padding) for (y, x) in peaks]
+    best = max(map(abs, nccs), default=0.0)
+    if best < min_confidence:
+        raise MarkerNotFound(reason, best)
+
+def _filter_markers(markers, min_confidence, min_psr, quality):
+    """Takes markers as (x, y, marker_type, score, ncc, psr), drops those below the thresholds and
+        raises MarkerNotFound if none is left. The quality measures are stripped unless quality is
+        True."""
+    if min_confidence is not None or min_psr is not None:
+        accepted = [m for m in markers if (min_confidence is None or abs(m[4]) >= min_confidence)
+                                          and (min_psr is None or m[5] >= min_psr)]
+        if not accepted:
+            best = max((abs(m[4]) for m in markers), default=0.0)
+            if not markers:
+                reason = "No marker candidate found"
+            elif min_confidence is not None and best < min_confidence:
+                reason = "No marker exceeded the confidence threshold"
+            else:
+                reason = "No marker exceeded the peak-to-sidelobe ratio threshold"
+            raise MarkerNotFound(reason, best)
+        markers = accepted
+    if not quality:
+        markers = [m[:4] for m in markers]
+    return markers
+
+def _subpixel_offset(response, x, y):
+    """Refines a peak of the response map by fitting a parabola in x and y direction.
+        Returns the offsets (dx, dy) in [-0.5, 0.5]."""
+    def offset(left, center, right):
+        curvature = left - 2.0 * center + right
+        if curvature >= 0.0:
+            return 0.0
+        return float(np.clip(0.5 * (left - right) / curvature, -0.5, 0.5))
+
+    h, w = response.shape
+    dx = offset(response[y, x - 1], response[y, x], response[y, x + 1]) if 0 < x < w - 1 else 0.0
+    dy = offset(response[y - 1, x], response[y, x], response[y + 1, x]) if 0 < y < h - 1 else 0.0
+    return dx, dy
+
+def _normalize_contrast(image, markersize):
+    """Applies CLAHE and normalizes the image to [-1, 1]."""
+    import skimage.exposure
+
+    image = skimage.exposure.equalize_adapthist(image, kernel_size=markersize)
+    image = image - image.min()
+    image /= image.max()
+    return (image - 0.5) * 2.0
+
+def _marker_type(image, x, y, markersize):
+    """Returns True if the center of the marker at (x, y) in the normalized image is white."""
+    def get_image_crop_coordinates(im, x, y, half_width):
+        """Helper function to crop a quadratic region around a center point out of an image
+        while respecting the image size."""
+        x1, x2 = max(0, x - half_width), min(x + half_width, im.shape[1])
+        y1, y2 = max(0, y - half_width), min(y + half_width, im.shape[0])
+        return (x1, y1, x2, y2)
+
+    # Crop the whole marker image out.
+    # Leave the outer frame out so that we ideally only have the one dark or bright ring.
+    x1, y1, x2, y2 = get_image_crop_coordinates(image, x, y, int((4 * markersize / 5) // 2 - 1))
+    whole_marker = image[y1:y2, x1:x2]
+    # Crop the inner section of the marker out.
+    ix1, iy1, ix2, iy2 = get_image_crop_coordinates(image, x, y, max(markersize // 8, 2))
+    inner_section = image[iy1:iy2, ix1:ix2]
+    # Mask the inner section in the whole-marker-crop.
+    inner_section_mask = np.zeros(shape=whole_marker.shape, dtype=bool)
+    inner_section_mask[(iy1-y1):(iy2-y2), (ix1-x1):(ix2-x2)] = True
+    whole_marker = np.ma.MaskedArray(data=whole_marker, mask=inner_section_mask)
+    # The type of the marker is defined by the brightness difference of the inner section and the
+    # rest.
+    return np.nanmedian(inner_section) > np.ma.median(whole_marker)
+
+def _locate_markers_coarse_to_fine(image, bank, n_markers, rescale, pad_borders, subpixel,
+                                   coarse_markersize, n_candidates, min_confidence, min_psr,
+                                   quality):
+    """Coarse-to-fine variant of locate_markers. Candidates are detected on a downscaled pyramid
+        level of the image with markers of approximately coarse_markersize pixels. Only windows
+        around the candidates are then rescaled by rescale and searched with the (finer) templates
+        of the bank.
+
+        Arguments:
+            image: Grayscale float image in [0, 1] at original resolution.
+            bank: MarkerTemplateBank for the rescaled image.
+            Other arguments as in locate_markers.
+    """
+    import skimage.feature
+    import skimage.transform
+
+    markersize = bank.markersize
+    coarse_scale = rescale * min(1.0, coarse_markersize / markersize)
+    coarse_bank = bank.coarse_bank(max(int(round(markersize * coarse_scale / rescale)), 4))
+
+    # Block averaging is much cheaper than a Gaussian anti-aliasing filter on the full image.
+    h, w = image.shape
+    factor = max(int(1.0 / coarse_scale), 1)
+    cropped_h, cropped_w = h - h % factor, w - w % factor
+    coarse = skimage.transform.downscale_local_mean(image[:cropped_h, :cropped_w], (factor, factor))
+    coarse = skimage.transform.rescale(coarse, coarse_scale * factor)
+    coarse_scale_y, coarse_scale_x = coarse.shape[0] / cropped_h, coarse.shape[1] / cropped_w
+    coarse_raw = coarse
+    coarse_padding = coarse_bank.markersize // 2 if pad_borders else 0
+    if coarse_padding:
+        coarse = np.pad(coarse, coarse_padding, "edge")
+    coarse = _normalize_contrast(coarse, coarse_bank.markersize)
+    coarse_convs = _template_response(coarse, coarse_bank)
+    if n_candidates is None:
+        n_candidates = 4 * n_markers
+    candidates = skimage.feature.peak_local_max(coarse_convs,
+                                                min_distance=max(coarse_bank.markersize // 2, 1),
+                                                num_peaks=n_candidates)
+    if min_confidence is not None:
+        _check_candidates(coarse_raw, coarse_bank.templates, candidates, coarse_padding,
+                          min_confidence,
+                          "No marker candidate exceeded the confidence threshold on the coarse "
+                          "level")
+    with_quality = quality or min_confidence is not None or min_psr is not None
+
+    # Uncertainty of the candidate positions in pixels of the rescaled image.
+    search_radius = int(np.ceil(rescale / coarse_scale)) + 1
+    half_width = markersize + search_radius
+    results = []
+    for (cy, cx) in candidates:
+        # Candidate position in the original image.
+        ox = (cx - coarse_padding + 0.5) / coarse_scale_x - 0.5
+        oy = (cy - coarse_padding + 0.5) / coarse_scale_y - 0.5
+        # Crop the window from the original image, replicating the border pixels where necessary.
+        x0, y0 = int(round(ox - half_width / rescale)), int(round(oy - half_width / rescale))
+        size = int(np.ceil(2 * half_width / rescale)) + 1
+        xs = np.clip(np.arange(x0, x0 + size), 0, w - 1)
+        ys = np.clip(np.arange(y0, y0 + size), 0, h - 1)
+        window = image[ys[:, None], xs[None, :]]
+        if rescale != 1.0:
+            window = skimage.transform.rescale(window, rescale)
+        # The rescaled window size is rounded, so the effective scale differs slightly from rescale.
+        scale_y, scale_x = window.shape[0] / size, window.shape[1] / size
+        raw_window = window
+        window = _normalize_contrast(window, markersize)
+        convs = _template_response(window, bank)
+
+        # Part of the window inside the image, the border pixels are replicated outside of it.
+        ix1, ix2 = max(int(np.ceil(-x0 * scale_x)), 0), int(np.floor((w - x0) * scale_x))
+        iy1, iy2 = max(int(np.ceil(-y0 * scale_y)), 0), int(np.floor((h - y0) * scale_y))
+        # Only accept peaks close to the candidate (and inside the image without padding).
+        center_x, center_y = int(round((ox - x0) * scale_x)), int(round((oy - y0) * scale_y))
+        wx1, wx2 = center_x - search_radius, center_x + search_radius + 1
+        wy1, wy2 = center_y - search_radius, center_y + search_radius + 1
+        if not pad_borders:
+            wx1, wx2 = max(wx1, ix1), min(wx2, ix2)
+            wy1, wy2 = max(wy1, iy1), min(wy2, iy2)
+        region = convs[wy1:wy2, wx1:wx2]
+        if region.size == 0:
+            continue
+        y, x = np.unravel_index(np.argmax(region), region.shape)
+        x, y = x + wx1, y + wy1
+        marker_type = _marker_type(window, x, y, markersize)
+        dx, dy = _subpixel_offset(convs, x, y) if subpixel else (0.0, 0.0)
+        ncc, psr = None, None
+        if with_quality:
+            ncc = _ncc(raw_window[iy1:iy2, ix1:ix2], bank.templates, x - ix1, y - iy1)
+            psr = _psr(convs, x, y, markersize)
+        # Map pixel centers of the rescaled window back to the original image.
+        x_, y_ = x0 + (x + dx + 0.5) / scale_x - 0.5, y0 + (y + dy + 0.5) / scale_y - 0.5
+        results.append((convs[y, x] / len(bank), x_, y_, marker_type, ncc, psr))
+
+    # Several candidates can converge to the same marker; keep the best one.
+    results = sorted(results, key=lambda r: r[0], reverse=True)
+    markers = []
+    min_distance = markersize / rescale / 2
+    for (score, x, y, marker_type, ncc, psr) in results:
+        if any((x - m[0]) ** 2 + (y - m[1]) ** 2 < min_distance ** 2 for m in markers):
+            continue
+        markers.append((x, y, marker_type, score, ncc, psr))
+    return _filter_markers(markers[:n_markers], min_confidence, min_psr, quality)
+
+# Marker size in pixels that images are rescaled to with rescale="auto".
+_AUTO_RESCALE_MARKERSIZE = 40
+
+def locate_markers(image, markersize, n_markers, marker=None, rescale="auto", pad_borders=True,
+                   subpixel=True, coarse_to_fine=False, coarse_markersize=10, n_candidates=None,
+                   min_confidence=None, min_psr=None, quality=False):
     """Attempts to locate markers in an image. The markersize in pixels must be approximately known.
         Returns the first n_markers with the highest score.
         The image can be rescaled automatically to make the convolution faster.
+        The template responses are computed with FFT-based convolution, transforming the image only
+        once.
 
         Arguments:
             image: Image to search (e.g. as returned by scipy.ndimage.imread).
             markersize: Approximate size of the markers in pixels.
             n_markers: Amount of markers to return.
             marker: (optional) numpy array; marker template. Will be loaded with get_marker() if not given.
+                    Can also be a MarkerTemplateBank, which avoids recomputing the templates.
+                    With rescale="auto", the image is then scaled to the bank's marker size.
             rescale: scaling factor for the image. "auto" means that the image will be scaled so that the markers are still sufficiently larger.
             pad_borders: Whether to pad the image borders to be able to recognize cut-off markers.
+            subpixel: Whether to refine the marker positions to sub-pixel accuracy.
+            coarse_to_fine: Whether to detect candidates on a downscaled image first and only search
+                            small windows around them at the rescaled resolution.
+                            The cost then grows with n_markers instead of the image area.
+                            Without a given MarkerTemplateBank, finer scale and rotation steps
+                            are used.
+            coarse_markersize: Approximate marker size in pixels on the coarse level.
+            n_candidates: Number of coarse candidates to refine (or to check with min_confidence).
+                          Defaults to 4 * n_markers.
+            min_confidence: (optional) Minimum absolute normalized cross-correlation in [0, 1] of a
+                            marker with the best matching template. If given, the candidates are
+                            first checked with a single template (or on the coarse level) and the
+                            search stops early if none of them exceeds the threshold.
+            min_psr: (optional) Minimum peak-to-sidelobe ratio of the template response of a marker.
+            quality: Whether to append the quality measures ncc and psr to each returned marker.
 
         Returns:
             list of (x, y, marker_type, score): x, y are pixel coordinates in the original image.
                                                 marker_type (boolean) True if the marker's center is white.
                                                 score: (float) arbitrary score of the marker's quality.
+            With quality=True, list of (x, y, marker_type, score, ncc, psr):
+                                                ncc: (float) normalized cross-correlation in
+                                                     [-1, 1]; negative for inverse markers.
+                                                psr: (float) peak-to-sidelobe ratio of the
+                                                     template response.
+
+        Raises:
+            MarkerNotFound: If thresholds are given and no marker exceeds them.
     """
     import skimage.feature
-    import skimage.morphology
+    import skimage.transform
 
-    import skimage.exposure
-    import skimage.filters
-    import scipy.signal
-    
-    if marker is None:
-        marker = get_marker()
+    bank = marker if isinstance(marker, MarkerTemplateBank) else None
 
     if rescale == "auto":
-        rescale = 25 / markersize
-    
-    # Rescale marker.
-    marker = marker.astype(np.float32)
-    marker = marker - marker.min()
-    marker /= marker.max()
-    marker = (marker - 0.5) * 2.0
-    original_marker = marker
+        if bank is not None:
+            rescale = bank.markersize / markersize
+        else:
+            rescale = _AUTO_RESCALE_MARKERSIZE / markersize
 
-    # Rescale image.
     image = image.astype(np.float32)
     if image.max() > 1.0:
         image /= 255.0
-        
+    markersize = int(round(markersize * rescale))
+
+    if bank is None:
+        bank = _make_template_bank(markersize, marker=marker, coarse_to_fine=coarse_to_fine)
+    elif abs(bank.markersize - markersize) > 1:
+        raise ValueError("Marker size {} of the template bank does not match the rescaled marker "
+                         "size {}.".format(bank.markersize, markersize))
+
+    if coarse_to_fine:
+        return _locate_markers_coarse_to_fine(image, bank, n_markers, rescale, pad_borders,
+                                              subpixel, coarse_markersize, n_candidates,
+                                              min_confidence, min_psr, quality)
+
+    # Rescale image.
     if rescale != 1.0:
         image = skimage.transform.rescale(image, rescale)
-        markersize = int(markersize * rescale)
+    raw_image = image
     
     padding_width = 0
     if pad_borders:
         padding_width = markersize // 2
         image = np.pad(image, padding_width, "edge")
 
-    image = skimage.exposure.equalize_adapthist(image, kernel_size=markersize)
-    image = image - image.min()
-    image /= image.max()
-    image = (image - 0.5) * 2.0    
-    
-    steps = 3
-    rotation_steps = 3
-    convs = None
-    for step in range(steps):
-        s = (step - steps // 2) * 2
-        marker = skimage.transform.resize(original_marker, (markersize + s, markersize + s))
-        
-        for r in np.linspace(-5.0, +5.0, num=rotation_steps):
-            if r == 0.0:
-                rotated_marker = marker
-            else:
-                rotated_marker = skimage.transform.rotate(image = marker, angle=r, resize=True)
-            conv = scipy.signal.convolve2d(image, rotated_marker, mode="same")
-            conv2 = scipy.signal.convolve2d(image, -1.0 * rotated_marker, mode="same")
+    image = _normalize_contrast(image, markersize)
+    if min_confidence is not None:
+        # Check the candidates of the nominal template first to skip images without markers quickly.
+        nominal = bank.nominal_index
+        convs = _template_response(image, bank, indices=[nominal])
+        candidates = skimage.feature.peak_local_max(convs, num_peaks=n_candidates or 4 * n_markers)
+        _check_candidates(raw_image, [bank.templates[nominal]], candidates, padding_width,
+                          min_confidence,
+                          "No marker candidate exceeded the confidence threshold with the nominal "
+                          "template")
+        others = [i for i in range(len(bank)) if i != nominal]
+        convs = _template_response(image, bank, indices=others, response=convs)
+    else:
+        convs = _template_response(image, bank)
+    with_quality = quality or min_confidence is not None or min_psr is not None
 
-            conv = np.abs(conv) * np.abs(conv2)
-            if convs is None:
-                convs = conv
-            else:
-                idx = conv > convs
-                convs[idx] = conv[idx]
-            
     extrema = skimage.feature.peak_local_max(convs)
-    extrema = [(convs[y, x] / (rotation_steps * steps), x, y) for (y, x) in extrema]
+    extrema = [(convs[y, x] / len(bank), x, y) for (y, x) in extrema]
     extrema = sorted(extrema, reverse=True)
     
-    def get_image_crop_coordinates(im, x, y, half_width):
-        """Helper function to crop a quadratic region around a center point out of an image
-        while respecting the image size."""
-        x1, x2 = max(0, x - half_width), min(x + half_width, im.shape[1])
-        y1, y2 = max(0, y - half_width), min(y + half_width, im.shape[0])
-        return (x1, y1, x2, y2)
-
     results = []
     for (score, x, y) in extrema[:n_markers]:
-        # Crop the whole marker image out.
-        # Leave the outer frame out so that we ideally only have the one dark or bright ring.
-        x1, y1, x2, y2 = get_image_crop_coordinates(image, x, y, int((4 * markersize / 5) // 2 - 1))
-        whole_marker = image[y1:y2, x1:x2]
-        # Crop the inner section of the marker out.
-        ix1, iy1, ix2, iy2 = get_image_crop_coordinates(image, x, y, max(markersize // 8, 2))
-        inner_section = image[iy1:iy2, ix1:ix2]
-        # Mask the inner section in the whole-marker-crop.
-        inner_section_mask = np.zeros(shape=whole_marker.shape, dtype=bool)
-        inner_section_mask[(iy1-y1):(iy2-y2), (ix1-x1):(ix2-x2)] = True
-        whole_marker = np.ma.MaskedArray(data=whole_marker, mask=inner_section_mask)
-        # The type of the marker is defined by the brightness difference of the inner section and the rest.
-        marker_type = np.nanmedian(inner_section) > np.ma.median(whole_marker)
-        results.append(((x - padding_width) / rescale, (y - padding_width) / rescale, marker_type, score))
-    return results
+        marker_type = _marker_type(image, x, y, markersize)
+        dx, dy = _subpixel_offset(convs, x, y) if subpixel else (0.0, 0.0)
+        ncc, psr = None, None
+        if with_quality:
+            ncc = _ncc(raw_image, bank.templates, x - padding_width, y - padding_width)
+            psr = _psr(convs, x, y, markersize)
+        results.append(((x + dx - padding_width) / rescale, (y + dy - padding_width) / rescale,
+                        marker_type, score, ncc, psr))
+    return _filter_markers(results, min_confidence, min_psr, quality)
+
+def _get_executor(executor, max_workers):
+    """Returns (executor, owned) for the executor argument of locate_markers_in_corners.
+        owned is True if the executor was created here and has to be shut down by the caller."""
+    import concurrent.futures
+
+    if executor == "thread":
+        return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers), True
+    if executor == "process":
+        return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers), True
+    if executor is None or isinstance(executor, concurrent.futures.Executor):
+        return executor, False
+    raise ValueError("executor must be None, 'thread', 'process' or a concurrent.futures.Executor.")
+
+def _corner_bank(markersize, marker, kwargs):
+    """Builds the template bank for locate_markers once, so that it can be shared by all corners."""
+    if isinstance(marker, MarkerTemplateBank):
+        return marker
+    rescale = kwargs.get("rescale", "auto")
+    if rescale == "auto":
+        rescale = _AUTO_RESCALE_MARKERSIZE / markersize
+    return _make_template_bank(int(round(markersize * rescale)), marker=marker,
+                               coarse_to_fine=kwargs.get("coarse_to_fine", False))
+
+def _corner_crops(image, corner_ratio):
+    """Yields (x, y, sub_image) for the four corners of an image."""
+    h, w = image.shape[:2]
+    corner_w = int(w * corner_ratio)
+    corner_h = int(h * corner_ratio)
+    for (x, y) in ((0, 0), (w - corner_w, 0), (0, h - corner_h), (w - corner_w, h - corner_h)):
+        yield x, y, image[y:(y + corner_h), x:(x + corner_w)]
 
-def locate_markers_in_corners(image, markersize, marker=None, corner_ratio=0.25, **kwargs):
+def _locate_marker_in_corner(sub_image, x, y, markersize, marker, kwargs):
+    """Locates the best marker in a corner crop and returns it in the coordinates of the whole
+    image."""
+    if len(sub_image.shape) > 2:
+        import skimage.color
+        sub_image = skimage.color.rgb2hsv(sub_image)[:,:,2]
+    r = locate_markers(sub_image, markersize=markersize, marker=marker, n_markers=1, **kwargs)
+    if not r:
+        raise MarkerNotFound("No marker candidate found", 0.0)
+    x_, y_ = r[0][:2]
+    return (x_ + x, y_ + y) + tuple(r[0][2:])
+
+def locate_markers_in_corners(image, markersize, marker=None, corner_ratio=0.25, executor=None,
+                              max_workers=None, **kwargs):
     """Searches the four corners of an image for markers and returns four markers.
         
     Arguments:
         image: The image to pass to locate_markers.
         markersize: Approximate size of markers in the image in pixels.
-        marker: (optional) Marker template.
+        marker: (optional) Marker template or MarkerTemplateBank.
         corner_ratio: fraction of image width and height to search for a marker in each corner.
+        executor: (optional) Search the corners concurrently. Either "thread", "process" or an
+                  existing concurrent.futures.Executor. The FFTs release the GIL, so threads are
+                  usually sufficient.
+        max_workers: (optional) Number of workers if a new executor is created.
 
     Returns:
         list of (x, y, marker_type, score)x4: x, y are pixel coordinates in the original image.
                                             marker_type (boolean) True if the marker's center is white.
                                             score: (float) arbitrary score of the marker's quality.
+                                            With quality=True, ncc and psr are appended
+                                            (see locate_markers).
+
+    Raises:
+        MarkerNotFound: If thresholds are passed to locate_markers and a corner contains no
+                        sufficient marker.
     """
-    if len(image.shape) > 2:
-        import skimage.color
-        image = skimage.color.rgb2hsv(image)[:,:,2]
+    return locate_markers_in_corners_batch([image], markersize, marker=marker,
+                                           corner_ratio=corner_ratio, executor=executor,
+                                           max_workers=max_workers, **kwargs)[0]
 
-    h, w = image.shape
-    corner_w = int(image.shape[1] * corner_ratio)
-    corner_h = int(image.shape[0] * corner_ratio)
-    
-    results = []
-    for (x, y) in ((0, 0), (w - corner_w, 0), (0, h - corner_h), (w - corner_w, h - corner_h)):
-        sub_image = image[y:(y + corner_h), x:(x + corner_w)]
-        r = locate_markers(sub_image, markersize=markersize, marker=marker, n_markers=1, **kwargs)
-        x_, y_, t, s = r[0]
-        x_ += x
-        y_ += y
-        results.append((x_, y_, t, s))
+def locate_markers_in_corners_batch(images, markersize, marker=None, corner_ratio=0.25,
+                                    executor="thread", max_workers=None, errors="raise", **kwargs):
+    """Runs locate_markers_in_corners for a batch of images, processing all corners of all images
+        concurrently. The template bank is built only once for the whole batch.
+
+    Arguments:
+        images: Iterable of images, e.g. a generator that loads them lazily.
+                Only a bounded number of images is kept in memory at the same time.
+        executor: "thread", "process", an existing concurrent.futures.Executor or None
+                  (sequential).
+        errors: "raise" to propagate MarkerNotFound or "return" to put the exception in place of
+                the markers of images that failed the thresholds of locate_markers
+                (min_confidence, min_psr).
+        Other arguments as in locate_markers_in_corners.
+
+    Returns:
+        list with the four markers (or a MarkerNotFound) of each image, in the order of the images.
+    """
+    import collections
+    import functools
+    import os
+
+    if errors not in ("raise", "return"):
+        raise ValueError("errors must be 'raise' or 'return'.")
+
+    def collect(corners):
+        """Returns the markers of one image from four callables or the MarkerNotFound of the first
+        failure."""
+        try:
+            return [corner() for corner in corners]
+        except MarkerNotFound as e:
+            if errors == "raise":
+                raise
+            return e
+
+    bank = _corner_bank(markersize, marker, kwargs)
+    locate = functools.partial(_locate_marker_in_corner, markersize=markersize, marker=bank,
+                               kwargs=kwargs)
+    executor, owned = _get_executor(executor, max_workers)
+    if executor is None:
+        return [collect([functools.partial(locate, sub_image, x, y)
+                         for (x, y, sub_image) in _corner_crops(image, corner_ratio)])
+                for image in images]
+
+    def collect_futures(futures):
+        result = collect([future.result for future in futures])
+        if isinstance(result, MarkerNotFound):
+            for future in futures:
+                future.cancel()
+        return result
+
+    max_pending = 2 * (max_workers or os.cpu_count() or 1)
+    results, pending = [], collections.deque()
+    try:
+        for image in images:
+            pending.append([executor.submit(locate, sub_image, x, y)
+                            for (x, y, sub_image) in _corner_crops(image, corner_ratio)])
+            while len(pending) > max_pending:
+                results.append(collect_futures(pending.popleft()))
+        while pending:
+            results.append(collect_futures(pending.popleft()))
+    finally:
+        if owned:
+            executor.shutdown()
     return results
 
 def arg_clockwise_order(pts):
@@ -291,6 +782,276 @@ def match_homography_points(points, scale=10.0, year=2019):
     H, _ = cv2.findHomography(xy, target_points)
     return H
 
+def transform_points(points, homographies, indices=None, angles=None, dtype=np.float64,
+                     chunk_size=2 ** 20):
+    """Applies homographies (e.g. as returned by match_homography_points) to pixel coordinates.
+        Every point can use a different homography, so detections from several cameras and
+        calibration periods can be transformed in one pass.
+
+        Arguments:
+            points: [N, 2] array of (x, y) pixel coordinates.
+            homographies: [3, 3] homography matrix or [K, 3, 3] array of homography matrices.
+            indices: (optional) [N] integer array; index in [0, K) of the homography for every
+                     point. Required if more than one homography is given, not allowed for a
+                     single [3, 3] matrix.
+            angles: (optional) [N] array of orientations in radians, measured like arctan2(dy, dx)
+                    in pixel coordinates. They are transformed with the local Jacobian of the
+                    homography.
+            dtype: Floating point type used for the computation and the results, e.g. np.float32 to
+                   halve the memory usage for large arrays.
+            chunk_size: Number of points that are transformed at once.
+
+        Returns:
+            [N, 2] array of transformed coordinates (e.g. in mm) or, if angles are given,
+            a tuple of the coordinates and the [N] array of transformed angles.
+
+        Raises:
+            ValueError: If the shapes do not match or an index is outside of [0, K).
+    """
+    points = np.asarray(points)
+    if points.ndim != 2 or points.shape[1] != 2:
+        raise ValueError("points must be of shape [N, 2].")
+    homographies = np.asarray(homographies, dtype=dtype)
+    if homographies.ndim == 2:
+        if indices is not None:
+            raise ValueError("indices can only be given with a [K, 3, 3] array of homographies.")
+        homographies = homographies[None]
+    elif indices is None:
+        if homographies.shape[0] != 1:
+            raise ValueError("indices are required if more than one homography is given.")
+    else:
+        indices = np.asarray(indices)
+        if indices.shape != (points.shape[0],):
+            raise ValueError("indices must be of shape [N].")
+        if indices.size and (indices.min() < 0 or indices.max() >= homographies.shape[0]):
+            raise ValueError("indices must be in [0, {}).".format(homographies.shape[0]))
+
+    n = points.shape[0]
+    transformed = np.empty((n, 2), dtype=dtype)
+    transformed_angles = np.empty(n, dtype=dtype) if angles is not None else None
+    for begin in range(0, n, chunk_size):
+        end = min(begin + chunk_size, n)
+        # [3, 3] or [chunk, 3, 3]; gathering per chunk bounds the memory of the per-point matrices.
+        H = homographies[0] if indices is None else homographies[indices[begin:end]]
+        x = points[begin:end, 0].astype(dtype, copy=False)
+        y = points[begin:end, 1].astype(dtype, copy=False)
+        w = H[..., 2, 0] * x + H[..., 2, 1] * y + H[..., 2, 2]
+        tx = (H[..., 0, 0] * x + H[..., 0, 1] * y + H[..., 0, 2]) / w
+        ty = (H[..., 1, 0] * x + H[..., 1, 1] * y + H[..., 1, 2]) / w
+        transformed[begin:end, 0] = tx
+        transformed[begin:end, 1] = ty
+
+        if angles is not None:
+            a = np.asarray(angles[begin:end]).astype(dtype, copy=False)
+            dx, dy = np.cos(a), np.sin(a)
+            # Jacobian of the projective transformation applied to the direction vector.
+            jx = ((H[..., 0, 0] - tx * H[..., 2, 0]) * dx
+                  + (H[..., 0, 1] - tx * H[..., 2, 1]) * dy) / w
+            jy = ((H[..., 1, 0] - ty * H[..., 2, 0]) * dx
+                  + (H[..., 1, 1] - ty * H[..., 2, 1]) * dy) / w
+            transformed_angles[begin:end] = np.arctan2(jy, jx)
+
+    if angles is not None:
+        return transformed, transformed_angles
+    return transformed
+
+class HomographyStore:
+    """Table of homographies (e.g. as returned by match_homography_points) per camera and time.
+        Every entry (cam_id, valid_from, H) is valid for its camera from valid_from until the next
+        entry of the same camera. The table is saved as a single structured .npy file that is
+        memory-mapped on load.
+
+        Example:
+            store = HomographyStore()
+            store.add(0, "2019-07-20", match_homography_points(markers))
+            store.save("homographies.npy")
+            mm = HomographyStore.load("homographies.npy").transform(xy, cam_ids, timestamps)
+
+        Arguments:
+            table: (optional) Structured array with the fields of HomographyStore.dtype.
+    """
+    dtype = np.dtype([("cam_id", np.int32), ("valid_from", "datetime64[ns]"),
+                      ("H", np.float64, (3, 3))])
+
+    def __init__(self, table=None):
+        if table is None:
+            table = np.zeros(0, dtype=self.dtype)
+        self._set_table(table)
+
+    def _set_table(self, table):
+        if table.dtype != self.dtype:
+            raise ValueError("table must be of dtype {}.".format(self.dtype))
+        order = np.lexsort((table["valid_from"], table["cam_id"]))
+        if np.any(order != np.arange(len(table))):
+            table = table[order]
+        self.table = table
+        self._build_index()
+
+    def _build_index(self):
+        # Lookup keys consist of the rank of the camera in the upper bits and the
+        # nanoseconds since the first valid_from in the lower bits.
+        self._cam_ids = np.unique(self.table["cam_id"])
+        self._time_bits = 63 - max(int(len(self._cam_ids) - 1).bit_length(), 1)
+        self._origin = self.table["valid_from"].min() if len(self.table) else np.datetime64(0, "ns")
+        offsets = (self.table["valid_from"] - self._origin).astype(np.int64)
+        if len(offsets) and offsets.max() >= 2 ** self._time_bits:
+            raise ValueError("The time range of the store is too large for {} cameras.".format(
+                len(self._cam_ids)))
+        ranks = np.searchsorted(self._cam_ids, self.table["cam_id"]).astype(np.int64)
+        self._keys = np.left_shift(ranks, self._time_bits) | offsets
+
+    @classmethod
+    def from_records(cls, cam_ids, valid_from, homographies):
+        """Creates a store from arrays of camera IDs, validity start times and [N, 3, 3]
+        homographies."""
+        valid_from = to_naive_utc_datetime64(valid_from)
+        table = np.zeros(len(valid_from), dtype=cls.dtype)
+        table["cam_id"] = cam_ids
+        table["valid_from"] = valid_from
+        table["H"] = homographies
+        return cls(table)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Loads a store saved with save. The table is memory-mapped unless mmap is False."""
+        return cls(np.load(path, mmap_mode="r" if mmap else None))
+
+    def save(self, path):
+        np.save(path, np.ascontiguousarray(self.table))
+
+    def add(self, cam_id, valid_from, H):
+        """Adds the homography H for camera cam_id that is valid from valid_from on."""
+        other = HomographyStore.from_records([cam_id], [valid_from], np.asarray(H)[None])
+        self._set_table(np.concatenate((self.table, other.table)))
+
+    def __len__(self):
+        return len(self.table)
+
+    @property
+    def homographies(self):
+        """[N, 3, 3] array of all homographies in the order of the table."""
+        return self.table["H"]
+
+    def lookup(self, cam_ids, timestamps):
+        """Returns the indices of the valid table entries for arrays of camera IDs and timestamps.
+            The index is -1 where no homography is valid, i.e. for unknown cameras or timestamps
+            before the first entry of the camera.
+        """
+        timestamps = to_naive_utc_datetime64(timestamps)
+        cam_ids = np.broadcast_to(np.asarray(cam_ids), timestamps.shape)
+        ranks = np.searchsorted(self._cam_ids, cam_ids)
+        known = ranks < len(self._cam_ids)
+        known[known] = self._cam_ids[ranks[known]] == cam_ids[known]
+
+        offsets = (timestamps - self._origin).astype(np.int64)
+        valid = known & (offsets >= 0)
+        offsets = np.clip(offsets, 0, 2 ** self._time_bits - 1)
+        keys = np.left_shift(np.minimum(ranks, max(len(self._cam_ids) - 1, 0)).astype(np.int64),
+                             self._time_bits) | offsets
+        indices = np.searchsorted(self._keys, keys, side="right") - 1
+        # The preceding entry may belong to a different camera.
+        valid &= indices >= 0
+        valid[valid] = self.table["cam_id"][indices[valid]] == cam_ids[valid]
+        return np.where(valid, indices, -1)
+
+    def get_homographies(self, cam_ids, timestamps):
+        """Returns the [N, 3, 3] valid homographies for arrays of camera IDs and timestamps.
+            Homographies are NaN where none is valid.
+        """
+        indices = self.lookup(cam_ids, timestamps)
+        if len(self):
+            H = self.homographies[np.maximum(indices, 0)]
+        else:
+            H = np.zeros((len(indices), 3, 3))
+        H[indices == -1] = np.nan
+        return H
+
+    def transform(self, points, cam_ids, timestamps, angles=None, dtype=np.float64,
+                  chunk_size=2 ** 20):
+        """Transforms pixel coordinates (and optionally angles) with the homographies that are valid
+            for the given cameras and timestamps. See transform_points for the arguments.
+            The results are NaN where no homography is valid.
+        """
+        indices = self.lookup(cam_ids, timestamps)
+        valid = indices >= 0
+        n = len(indices)
+        if not np.any(valid):
+            transformed = np.full((n, 2), np.nan, dtype=dtype)
+            return transformed if angles is None else (transformed, np.full(n, np.nan, dtype=dtype))
+        # Points without a valid homography are transformed with the first one and set to NaN.
+        result = transform_points(points, self.homographies, indices=np.where(valid, indices, 0),
+                                  angles=angles, dtype=dtype, chunk_size=chunk_size)
+        for values in (result if angles is not None else (result, )):
+            values[~valid] = np.nan
+        return result
+
+def track_homographies(frames, markersize, marker=None, corner_ratio=0.25, search_radius=None,
+                       tolerance=1.0, scale=10.0, year=2019, **kwargs):
+    """Calibrates a homography for every frame of a video and follows slow camera drift.
+        The markers are located in the corners of the first frame. For the following frames, only
+        small windows around the previous marker positions are searched. The homography is only
+        recomputed when a marker moved more than tolerance pixels since the last computation.
+        If a marker is lost (it left its search window, changed its type or fell below the
+        thresholds passed to locate_markers), the corners are searched again.
+        If that search fails as well (MarkerNotFound, e.g. for a dark or occluded frame), None is
+        yielded as the homography of the frame and the corners are searched again in the next
+        frame.
+
+    Arguments:
+        frames: Iterable of images; consumed lazily.
+        markersize: Approximate size of markers in the image in pixels.
+        marker: (optional) Marker template or MarkerTemplateBank.
+        corner_ratio: fraction of image width and height to search for a marker in each corner.
+        search_radius: (optional) Maximum marker movement between two frames in pixels.
+                       Defaults to markersize // 2.
+        tolerance: Marker movement in pixels after which the homography is recomputed.
+        scale, year: Passed to match_homography_points.
+        kwargs: Passed to locate_markers.
+
+    Yields:
+        (frame_idx, H): Index of the frame and the homography matrix that is valid for it, or None
+            if the markers could not be located in the frame.
+    """
+    if search_radius is None:
+        search_radius = markersize // 2
+    bank = _corner_bank(markersize, marker, kwargs)
+    half_width = int(markersize + search_radius)
+
+    markers, anchors, H = None, None, None
+    for frame_idx, frame in enumerate(frames):
+        if markers is not None:
+            h, w = frame.shape[:2]
+            tracked = []
+            for (x, y, t) in (m[:3] for m in markers):
+                cx, cy = int(round(x)), int(round(y))
+                x1, y1 = max(cx - half_width, 0), max(cy - half_width, 0)
+                x2, y2 = min(cx + half_width + 1, w), min(cy + half_width + 1, h)
+                try:
+                    m = _locate_marker_in_corner(frame[y1:y2, x1:x2], x1, y1, markersize, bank,
+                                                 kwargs)
+                except MarkerNotFound:
+                    m = None
+                if m is None or m[2] != t or (m[0] - x) ** 2 + (m[1] - y) ** 2 > search_radius ** 2:
+                    tracked = None
+                    break
+                tracked.append(m)
+            markers = tracked
+
+        if markers is None:
+            anchors = None
+            try:
+                markers = locate_markers_in_corners(frame, markersize, marker=bank,
+                                                    corner_ratio=corner_ratio, **kwargs)
+            except MarkerNotFound:
+                yield frame_idx, None
+                continue
+
+        positions = np.array([m[:2] for m in markers])
+        if anchors is None or np.max(np.linalg.norm(positions - anchors, axis=1)) > tolerance:
+            H = match_homography_points(markers, scale=scale, year=year)
+            anchors = positions
+        yield frame_idx, H
+
 def display_markers(image, markers, homography=None, figsize=(20, 8), dsize=None):
     """Helper function to display the recognized markers in an image.
         Can optionally take and apply a homography matrix H.
@@ -304,7 +1065,7 @@ def display_markers(image, markers, homography=None, figsize=(20, 8), dsize=None
     """
     fig, (ax1, ax2) = plt.subplots(1, 2, figsize=figsize)
     ax1.imshow(image, cmap="gray")
-    for (x, y, t, score) in markers:
+    for (x, y, t) in (m[:3] for m in markers):
         ax1.scatter(x, y, c=["b", "r"][int(t)], marker="s")
     if homography is not None:
         import cv2
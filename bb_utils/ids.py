@@ -3,6 +3,139 @@ import numpy as np
 from bb_utils.visualization import TagArtist
 
 
+# Maps every supported name of an ID representation to its canonical name.
+_REPRESENTATIONS = {
+    'bin_9': 'bin_9',
+    'bin_12': 'bin_12',
+    'bb_binary': 'bin_12',
+    'dec_9': 'ferwar',
+    'ferwar': 'ferwar',
+    'dec_12': 'dec_12',
+    'dec_12_reverse': 'dec_12_reverse',
+}
+_BINARY_REPRESENTATIONS = ('bin_9', 'bin_12')
+
+
+def _canonical_representation(representation):
+    try:
+        return _REPRESENTATIONS[representation]
+    except KeyError:
+        raise ValueError('Unknown ID representation {}, expected one of {}'.format(
+            representation, sorted(_REPRESENTATIONS)))
+
+
+def _bits_to_dec(bits):
+    """Interpret the last axis of a bit array as an unsigned integer, most significant bit first."""
+    nb_bits = bits.shape[-1]
+    return np.dot(bits, np.left_shift(1, np.arange(nb_bits - 1, -1, -1, dtype=np.int64)))
+
+
+def _dec_to_bits(ids, nb_bits=12):
+    """Expand integers into a bit array with a new last axis, most significant bit first."""
+    shifts = np.arange(nb_bits - 1, -1, -1, dtype=np.int64)
+    return (np.right_shift(ids[..., None], shifts) & 1).astype(np.uint8)
+
+
+def _batch_from_dec_12(ids, representation):
+    if representation == 'dec_12':
+        return ids
+    elif representation == 'bin_12':
+        return _dec_to_bits(ids)
+    elif representation == 'bin_9':
+        return np.roll(_dec_to_bits(ids), 3, axis=-1)
+    elif representation == 'dec_12_reverse':
+        return _bits_to_dec(_dec_to_bits(ids)[..., ::-1])
+    elif representation == 'ferwar':
+        bin_9 = np.roll(_dec_to_bits(ids), 3, axis=-1)
+        # uneven parity bit was used if the parity over all 12 bits is odd
+        parity = np.bitwise_xor.reduce(bin_9, axis=-1).astype(np.int64)
+        return _bits_to_dec(bin_9[..., :11]) + np.left_shift(parity, 11)
+
+
+_DECIMAL_REPRESENTATIONS = ('ferwar', 'dec_12', 'dec_12_reverse')
+_conversion_tables = None
+
+
+def _get_conversion_tables():
+    """Return the dense lookup tables for all conversions from a decimal representation.
+
+    Note:
+        There are only 4096 possible IDs, so each table has 4096 entries indexed by the ID in
+        the source representation. Tables are keyed by (source, target) and hold int16
+        decimal IDs or [4096, 12] uint8 bit arrays. They are built once, at first use.
+    """
+    global _conversion_tables
+    if _conversion_tables is None:
+        all_ids = np.arange(4096, dtype=np.int64)
+        from_dec_12 = {}
+        for target in _DECIMAL_REPRESENTATIONS + _BINARY_REPRESENTATIONS:
+            table = _batch_from_dec_12(all_ids, target)
+            dtype = np.uint8 if target in _BINARY_REPRESENTATIONS else np.int16
+            from_dec_12[target] = table.astype(dtype)
+
+        tables = {}
+        for source in _DECIMAL_REPRESENTATIONS:
+            # dec_12 ID stored at the index given by the ID in source representation
+            to_dec_12 = np.empty(4096, dtype=np.int64)
+            to_dec_12[from_dec_12[source]] = all_ids
+            for target, table in from_dec_12.items():
+                tables[(source, target)] = table[to_dec_12]
+        _conversion_tables = tables
+
+    return _conversion_tables
+
+
+def _check_decimal_ids(ids):
+    """Raise a ValueError if any decimal ID is outside of [0, 4096)."""
+    ids = np.asarray(ids)
+    if ids.size and (ids.min() < 0 or ids.max() >= 4096):
+        raise ValueError('Decimal IDs must be in [0, 4096), got values in [{}, {}]'.format(
+            ids.min(), ids.max()))
+    return ids
+
+
+def _check_bits(bits):
+    """Round a bit array, raise a ValueError unless it has shape [..., 12] and values in {0, 1}."""
+    bits = np.round(np.asarray(bits))
+    if bits.ndim == 0 or bits.shape[-1] != 12:
+        raise ValueError('Bit arrays must have 12 bits in the last axis, got shape {}'.format(
+            bits.shape))
+    if np.any((bits != 0) & (bits != 1)):
+        raise ValueError('Bits must round to 0 or 1, got values in [{}, {}]'.format(
+            bits.min(), bits.max()))
+    return bits.astype(np.int64)
+
+
+def _convert(ids, source, target):
+    """Convert IDs between canonical representations using the lookup tables."""
+    tables = _get_conversion_tables()
+    if source in _DECIMAL_REPRESENTATIONS:
+        ids = _check_decimal_ids(ids)
+    if source in _BINARY_REPRESENTATIONS:
+        bits = _check_bits(ids)
+        if source == 'bin_9':
+            bits = np.roll(bits, -3, axis=-1)
+        ids = _bits_to_dec(bits)
+        source = 'dec_12'
+        if target == 'dec_12':
+            return ids.astype(np.int16)
+
+    return tables[(source, target)][ids]
+
+
+def _batch_result(ids, source, target):
+    """Convert IDs like :func:`_convert`, returning decimal IDs as int64 for the public batch API.
+
+    Note:
+        The int16 lookup tables keep the gathers compact, but callers expect (and do arithmetic
+        with) int64 IDs.
+    """
+    ids = _convert(ids, source, target)
+    if target in _DECIMAL_REPRESENTATIONS:
+        return ids.astype(np.int64)
+    return ids
+
+
 class BeesbookID:
     def __init__(self, bee_id):
         if type(bee_id) is not np.array:
@@ -13,9 +146,8 @@ class BeesbookID:
 
     @staticmethod
     def _dec_to_bin(bee_id):
-        assert(bee_id < 4096)
-        bee_id = (np.array([2 ** i for i in range(11, -1, -1)]) & bee_id)
-        return bee_id.astype(bool).astype(int)
+        assert(0 <= bee_id < 4096)
+        return _get_conversion_tables()[('dec_12', 'bin_12')][bee_id]
 
     @classmethod
     def from_bin_9(cls, bee_id):
@@ -82,7 +214,8 @@ class BeesbookID:
             bee_id: ID in dec_12_reverse representation
         """
 
-        return cls(cls._dec_to_bin(bee_id)[::-1])
+        assert(0 <= bee_id < 4096)
+        return cls(_get_conversion_tables()[('dec_12_reverse', 'bin_12')][bee_id])
 
     @classmethod
     def from_ferwar(cls, bee_id):
@@ -97,17 +230,8 @@ class BeesbookID:
             bee_id: ID in ferwar representation
         """
 
-        needs_inverse_parity = bee_id >= 2048
-        bee_id = bee_id - 2048 if needs_inverse_parity else bee_id
-        bin_9 = cls._dec_to_bin(bee_id)
-        bin_9 = np.roll(bin_9, -1, axis=0)
-        parity = np.sum(bin_9[:-1]) % 2
-        if needs_inverse_parity:
-            bin_9[-1] = 1 - parity
-        else:
-            bin_9[-1] = parity
-
-        return cls.from_bin_9(bin_9)
+        assert(0 <= bee_id < 4096)
+        return cls(_get_conversion_tables()[('ferwar', 'bin_12')][bee_id])
 
     @classmethod
     def from_bb_binary(cls, bee_id):
@@ -144,7 +268,7 @@ class BeesbookID:
         Returns:
             :obj:`int`: ID in 'dec_12' decimal representation
         """
-        return np.sum(2 ** np.array(range(12))[::-1] * self.binary_12)
+        return _bits_to_dec(self.binary_12)
 
     def as_bin_9(self):
         """Return ID in 'bin_9' binary representation.
@@ -156,7 +280,7 @@ class BeesbookID:
         Returns:
             :obj:`np.array`: ID in bb_binary representation
         """
-        return np.roll(self.binary_12, 3, axis=0)
+        return _get_conversion_tables()[('dec_12', 'bin_9')][self.as_dec_12()].astype(int)
 
     def as_ferwar(self):
         """Return ID decimal representation originally used by Fernando Wario.
@@ -169,17 +293,7 @@ class BeesbookID:
         Returns:
             :obj:`int`: ID in ferwar decimal representation
         """
-        # convert to decimal id using 11 least significant bits
-        bin_9 = self.as_bin_9()
-        decimal_id = int(''.join([str(c) for c in bin_9[:11]]), 2)
-        parity_bit = bin_9[-1]
-
-        # determine what kind of parity bit was used and add 2^11 to decimal id
-        # if uneven parity bit was used
-        if (np.sum(bin_9[:11]) % 2) != parity_bit:
-            decimal_id += 2048
-
-        return decimal_id
+        return int(_get_conversion_tables()[('dec_12', 'ferwar')][self.as_dec_12()])
 
     def as_bb_binary(self):
         """Return ID in decoder binary representation.
@@ -196,6 +310,31 @@ class BeesbookID:
 
         return self.binary_12
 
+    @staticmethod
+    def batch_convert(ids, source, target):
+        """Vectorized conversion of a batch of IDs between any two representations.
+
+        Note:
+            Supported representations are 'bin_9', 'bin_12', 'bb_binary', 'dec_9', 'ferwar',
+            'dec_12' and 'dec_12_reverse'. Binary representations are arrays with shape
+            [..., 12] (values are rounded), decimal representations are integer arrays of any
+            shape. Bit arrays with another number of bits, bits that do not round to 0 or 1 and
+            decimal IDs outside of [0, 4096) raise a ValueError. Decimal IDs are converted with a
+            single gather from a precomputed lookup table, binary IDs additionally need one dot
+            product.
+
+        Arguments:
+            ids (:obj:`np.array`): array of IDs in `source` representation
+            source (:obj:`str`): representation of the given IDs
+            target (:obj:`str`): representation of the returned IDs
+
+        Returns:
+            :obj:`np.array`: array of IDs in `target` representation, int64 for decimal and
+            uint8 for binary representations
+        """
+        return _batch_result(ids, _canonical_representation(source),
+                             _canonical_representation(target))
+
     @staticmethod
     def batch_bb_binary_to_ferwar(ids):
         """Vectorized conversion of bb_binary IDs to ferwar decimal IDs.
@@ -211,19 +350,120 @@ class BeesbookID:
         Returns:
             :obj:`np.array`: array of decimal IDs in ferwar representation
         """
-        binary_ids = np.round(ids).astype(int)
+        return BeesbookID.batch_convert(ids, 'bb_binary', 'ferwar')
+
+    @staticmethod
+    def batch_decode_confidences(confidences, k=1, representation='dec_12', chunk_size=None,
+                                 eps=1e-6):
+        """Rank the most likely IDs for a batch of per-bit decoder confidences.
+
+        Note:
+            Bits are assumed to be independent. The log-likelihood of every possible ID is
+            computed with a single matrix product of the per-bit log-odds and the 4096x12 code
+            book of all IDs.
+
+        Arguments:
+            confidences (:obj:`np.array`): probabilities of each bit being set, in bb_binary
+                order, with shape [batch_size, 12]
+            k (:obj:`int`): number of candidate IDs to return per row
+            representation (:obj:`str`): representation of the returned IDs
+            chunk_size (:obj:`int`): (optional) number of rows scored at once, bounds the
+                temporary [chunk_size, 4096] score matrix
+            eps (:obj:`float`): confidences are clipped to [eps, 1 - eps]
 
-        adjusted_ids = np.roll(binary_ids, 3, axis=1)
+        Returns:
+            (:obj:`np.array`, :obj:`np.array`): candidate IDs with shape [batch_size, k] (plus
+            a trailing axis of 12 for binary representations), sorted by descending
+            log-likelihood, and their log-likelihoods with shape [batch_size, k]
+        """
+        representation = _canonical_representation(representation)
+        confidences = np.asarray(confidences)
+        dtype = np.result_type(confidences.dtype, np.float32)
+        confidences = np.clip(confidences.astype(dtype, copy=False), eps, 1 - eps)
+        if not 1 <= k <= 4096:
+            raise ValueError('k must be between 1 and 4096')
+        if chunk_size is not None and chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1, got {}'.format(chunk_size))
+
+        codebook = _get_conversion_tables()[('dec_12', 'bin_12')].T.astype(dtype)
+        nb_rows = len(confidences)
+        chunk_size = max(nb_rows, 1) if chunk_size is None else chunk_size
+
+        candidates = np.empty((nb_rows, k), dtype=np.int64)
+        log_likelihoods = np.empty((nb_rows, k), dtype=dtype)
+        for start in range(0, nb_rows, chunk_size):
+            chunk = confidences[start:start + chunk_size]
+            log_p, log_not_p = np.log(chunk), np.log1p(-chunk)
+            scores = np.dot(log_p - log_not_p, codebook)
+            scores += log_not_p.sum(axis=1, keepdims=True)
+
+            if k < 4096:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            else:
+                top = np.broadcast_to(np.arange(4096), scores.shape)
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            candidates[start:start + chunk_size] = np.take_along_axis(top, order, axis=1)
+            log_likelihoods[start:start + chunk_size] = np.take_along_axis(top_scores, order,
+                                                                           axis=1)
+
+        return _batch_result(candidates, 'dec_12', representation), log_likelihoods
 
-        # convert to decimal id using 11 least significant bits
-        decimal_ids = [int(''.join([str(c) for c in id[:11]]), 2) for id in adjusted_ids]
+    @staticmethod
+    def batch_nearest_valid_ids(ids, valid_ids, representation='dec_12', ignore_parity=False):
+        """Snap a batch of IDs to the nearest ID in a set of valid IDs by Hamming distance.
 
-        # determine what kind of parity bit was used and add 2^11 to decimal id
-        # uneven parity bit was used
-        decimal_ids = np.array(decimal_ids)
-        decimal_ids[(np.sum(adjusted_ids, axis=1) % 2) == 1] += 2048
+        Note:
+            Distances are computed as the popcount of the XOR of the 12 bit dec_12 codes. The
+            nearest valid ID is precomputed for all 4096 possible IDs, so each query is a gather.
+            If several valid IDs have the same distance, the one with the lowest dec_12 ID is
+            returned.
 
-        return decimal_ids
+            With `ignore_parity`, the parity bit (last bit in bin_9 representation) is excluded
+            from the distance, i.e. the ferwar IDs x and x + 2048 are treated as identical: if
+            both are valid, they count as a single candidate and the one with the lower dec_12
+            ID is returned.
+
+        Arguments:
+            ids (:obj:`np.array`): IDs to snap
+            valid_ids (:obj:`np.array`): set of allowed IDs, e.g. all known IDs of a colony
+            representation (:obj:`str`): representation of `ids`, `valid_ids` and the result
+            ignore_parity (:obj:`bool`): whether to ignore the parity bit
+
+        Returns:
+            (:obj:`np.array`, :obj:`np.array`, :obj:`np.array`): nearest valid IDs, Hamming
+            distances to them and the number of valid IDs with the same distance
+        """
+        representation = _canonical_representation(representation)
+        valid_ids = np.unique(_convert(valid_ids, representation, 'dec_12')).astype(np.uint16)
+        if len(valid_ids) == 0:
+            raise ValueError('Set of valid IDs is empty')
+
+        all_ids = np.arange(4096, dtype=np.uint16)
+        popcount = _dec_to_bits(all_ids).sum(axis=-1, dtype=np.uint8)
+        mask = np.uint16(4095 - 8 if ignore_parity else 4095)
+        if ignore_parity:
+            # keep one ID per pair differing only in the parity bit, so ties count each once
+            _, first = np.unique(valid_ids & mask, return_index=True)
+            valid_ids = np.sort(valid_ids[first])
+
+        nearest = np.empty(4096, dtype=np.int64)
+        distances = np.empty(4096, dtype=np.uint8)
+        ties = np.empty(4096, dtype=np.int64)
+        # bound the temporary [block_size, len(valid_ids)] distance matrix
+        block_size = 512
+        for start in range(0, 4096, block_size):
+            block = all_ids[start:start + block_size]
+            block_distances = popcount[(block[:, None] ^ valid_ids[None, :]) & mask]
+            best = np.argmin(block_distances, axis=1)
+            distances[start:start + block_size] = block_distances[np.arange(len(block)), best]
+            nearest[start:start + block_size] = valid_ids[best]
+            ties[start:start + block_size] = np.sum(
+                block_distances == distances[start:start + block_size, None], axis=1)
+
+        dec_12 = _convert(ids, representation, 'dec_12')
+        return (_batch_result(nearest[dec_12], 'dec_12', representation),
+                distances[dec_12], ties[dec_12])
 
     def __repr__(self):
         return 'BeesbookID(bb_binary|bin_12: {}, ferwar|dec_9 decimal: {})'.format(
@@ -232,4 +472,215 @@ class BeesbookID:
     def _repr_png_(self):
         print(self.__repr__())
 
-        return TagArtist().draw(self.binary_12)
+        return TagArtist().draw_cached(self.binary_12)
+
+
+class BeesbookIDArray:
+    """Compact array of IDs backed by a single uint16 array in dec_12 representation.
+
+    Note:
+        Each ID takes up two bytes. Slicing returns views, indexing with a single integer
+        returns a :class:`.BeesbookID`.
+
+    Arguments:
+        dec_12 (:obj:`np.array`): IDs in dec_12 representation
+
+    Raises:
+        ValueError: if any ID is outside of [0, 4096)
+    """
+
+    def __init__(self, dec_12):
+        self.dec_12 = np.asarray(_check_decimal_ids(dec_12), dtype=np.uint16)
+
+    @classmethod
+    def from_representation(cls, ids, representation):
+        """Initialize IDs from an array of IDs in the given representation.
+
+        Arguments:
+            ids (:obj:`np.array`): integer array or [..., 12] bit array of IDs
+            representation (:obj:`str`): representation of the IDs, see
+                :meth:`.BeesbookID.batch_convert`
+        """
+        representation = _canonical_representation(representation)
+        if representation == 'dec_12':
+            return cls(ids)
+        return cls(_convert(ids, representation, 'dec_12'))
+
+    @classmethod
+    def from_bin_9(cls, ids):
+        """Initialize IDs from a [..., 12] array in bin_9 representation."""
+        return cls.from_representation(ids, 'bin_9')
+
+    @classmethod
+    def from_bin_12(cls, ids):
+        """Initialize IDs from a [..., 12] array in bin_12 representation."""
+        return cls.from_representation(ids, 'bin_12')
+
+    @classmethod
+    def from_bb_binary(cls, ids):
+        """Initialize IDs from a [..., 12] array in bb_binary representation."""
+        return cls.from_representation(ids, 'bb_binary')
+
+    @classmethod
+    def from_dec_9(cls, ids):
+        """Initialize IDs from an array in dec_9 representation."""
+        return cls.from_representation(ids, 'dec_9')
+
+    @classmethod
+    def from_ferwar(cls, ids):
+        """Initialize IDs from an array in ferwar representation."""
+        return cls.from_representation(ids, 'ferwar')
+
+    @classmethod
+    def from_dec_12(cls, ids):
+        """Initialize IDs from an array in dec_12 representation."""
+        return cls.from_representation(ids, 'dec_12')
+
+    @classmethod
+    def from_dec_12_reverse(cls, ids):
+        """Initialize IDs from an array in dec_12_reverse representation."""
+        return cls.from_representation(ids, 'dec_12_reverse')
+
+    @classmethod
+    def from_ids(cls, bee_ids):
+        """Initialize IDs from an iterable of :class:`.BeesbookID` objects."""
+        # the reshape keeps the bit axis for an empty iterable
+        bits = np.reshape([bee_id.as_bb_binary() for bee_id in bee_ids], (-1, 12))
+        return cls.from_bb_binary(bits)
+
+    @classmethod
+    def from_series(cls, series, representation='dec_12'):
+        """Initialize IDs from a pandas column of decimal IDs.
+
+        Note:
+            No copy is made if the column already holds uint16 IDs in dec_12 representation.
+
+        Arguments:
+            series (:class:`pd.Series`): column of decimal IDs
+            representation (:obj:`str`): representation of the IDs in the column
+        """
+        return cls.from_representation(series.to_numpy(copy=False), representation)
+
+    def as_representation(self, representation):
+        """Return IDs in the given representation.
+
+        Arguments:
+            representation (:obj:`str`): see :meth:`.BeesbookID.batch_convert`
+
+        Returns:
+            :obj:`np.array`: integer array or [..., 12] uint8 bit array of IDs
+        """
+        representation = _canonical_representation(representation)
+        if representation == 'dec_12':
+            return self.dec_12
+        return _convert(self.dec_12, 'dec_12', representation)
+
+    def as_bin_9(self):
+        """Return IDs as a [..., 12] bit array in bin_9 representation."""
+        return self.as_representation('bin_9')
+
+    def as_bin_12(self):
+        """Return IDs as a [..., 12] bit array in bin_12 representation."""
+        return self.as_representation('bin_12')
+
+    def as_bb_binary(self):
+        """Return IDs as a [..., 12] bit array in bb_binary representation."""
+        return self.as_representation('bb_binary')
+
+    def as_dec_9(self):
+        """Return IDs in dec_9 representation."""
+        return self.as_representation('dec_9')
+
+    def as_ferwar(self):
+        """Return IDs in ferwar representation."""
+        return self.as_representation('ferwar')
+
+    def as_dec_12(self):
+        """Return IDs in dec_12 representation."""
+        return self.as_representation('dec_12')
+
+    def as_dec_12_reverse(self):
+        """Return IDs in dec_12_reverse representation."""
+        return self.as_representation('dec_12_reverse')
+
+    def to_series(self, index=None, name='dec_12'):
+        """Return IDs as a pandas column of uint16 dec_12 IDs without copying them.
+
+        Arguments:
+            index: (optional) index of the returned column
+            name (:obj:`str`): name of the returned column
+
+        Returns:
+            :class:`pd.Series`: column of IDs in dec_12 representation
+        """
+        import pandas as pd
+
+        return pd.Series(self.dec_12, index=index, name=name, copy=False)
+
+    def unique(self, return_index=False, return_inverse=False, return_counts=False):
+        """Find the unique IDs, see :func:`np.unique`.
+
+        Returns:
+            :class:`.BeesbookIDArray` of sorted unique IDs, followed by the optional arrays
+            requested as in :func:`np.unique`
+        """
+        result = np.unique(self.dec_12, return_index=return_index,
+                           return_inverse=return_inverse, return_counts=return_counts)
+        if isinstance(result, tuple):
+            return (BeesbookIDArray(result[0]), ) + result[1:]
+        return BeesbookIDArray(result)
+
+    def group_indices(self):
+        """Group positions by ID.
+
+        Returns:
+            (:class:`.BeesbookIDArray`, [:obj:`np.array`]): sorted unique IDs and for each of them
+            the positions at which it occurs
+        """
+        order = np.argsort(self.dec_12, kind='stable')
+        unique_ids, starts = np.unique(self.dec_12[order], return_index=True)
+        return BeesbookIDArray(unique_ids), np.split(order, starts[1:])
+
+    @property
+    def nbytes(self):
+        return self.dec_12.nbytes
+
+    @property
+    def shape(self):
+        return self.dec_12.shape
+
+    def __len__(self):
+        return len(self.dec_12)
+
+    def __iter__(self):
+        for dec_12 in self.dec_12:
+            yield BeesbookID.from_dec_12(int(dec_12))
+
+    def __getitem__(self, index):
+        dec_12 = self.dec_12[index]
+        if np.ndim(dec_12) == 0:
+            return BeesbookID.from_dec_12(int(dec_12))
+        return BeesbookIDArray(dec_12)
+
+    def __eq__(self, other):
+        if isinstance(other, BeesbookIDArray):
+            return self.dec_12 == other.dec_12
+        if isinstance(other, BeesbookID):
+            return self.dec_12 == other.as_dec_12()
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return ~result
+
+    __hash__ = None
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None or np.dtype(dtype) == self.dec_12.dtype:
+            return self.dec_12
+        return self.dec_12.astype(dtype)
+
+    def __repr__(self):
+        return 'BeesbookIDArray(dec_12: {})'.format(self.dec_12)
@@ -1,31 +1,492 @@
+import functools
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
 import numpy as np
 import pkg_resources
 import pandas as pd
 
-from bb_utils.ids import BeesbookID
+from bb_utils.ids import BeesbookID, BeesbookIDArray
+from bb_utils.timestamps import to_naive_utc_datetime64
+
+
+def _as_id_array(bee_ids, representation):
+    if isinstance(bee_ids, BeesbookIDArray):
+        return bee_ids
+    if isinstance(bee_ids, BeesbookID):
+        return BeesbookIDArray.from_bb_binary(bee_ids.as_bb_binary()[None])
+    return BeesbookIDArray.from_representation(np.asarray(bee_ids), representation)
+
+
+def _like_input(result, *inputs):
+    """Return result as pd.Series aligned with the first pd.Series in inputs, if there is one."""
+    for arg in inputs:
+        if isinstance(arg, pd.Series):
+            return pd.Series(result, index=arg.index)
+    return result
+
+
+# Keys of the ID mapping index consist of the season index, the ferwar ID and the time offset in
+# us since the first change point of the season (45 bits, ~1.1 years). Up to 64 seasons fit.
+_MAPPING_TIME_BITS = 45
+_MAPPING_SEASON_SHIFT = _MAPPING_TIME_BITS + 12
+
+
+def _data_path(filename):
+    return pkg_resources.resource_filename('bb_utils', 'data/' + filename)
+
+
+def _cache_dir():
+    """Directory of the compiled table cache, can be set with the BB_UTILS_CACHE_DIR variable."""
+    if 'BB_UTILS_CACHE_DIR' in os.environ:
+        return os.environ['BB_UTILS_CACHE_DIR']
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'bb_utils')
+
+
+# Version of the layout of the cached arrays, part of the cache key.
+_CACHE_VERSION = 2
+
+
+def _save_arrays(arrays, cache_path):
+    # one .npy file per array so that every array can be memory-mapped, object arrays (strings)
+    # are stored as fixed width unicode plus a missing mask
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(cache_path))
+    try:
+        np.save(os.path.join(tmp_path, 'names.npy'), np.array(list(arrays), dtype=str))
+        for idx, values in enumerate(arrays.values()):
+            if values.dtype == object:
+                missing = pd.isna(values)
+                np.save(os.path.join(tmp_path, '{}.npy'.format(idx)),
+                        np.where(missing, '', values).astype(str))
+                np.save(os.path.join(tmp_path, '{}_missing.npy'.format(idx)), missing)
+            else:
+                np.save(os.path.join(tmp_path, '{}.npy'.format(idx)), values)
+        os.rename(tmp_path, cache_path)
+    finally:
+        # the cache might have been written concurrently by another process
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _load_arrays(cache_path):
+    names = np.load(os.path.join(cache_path, 'names.npy'))
+    arrays = {}
+    for idx, name in enumerate(names):
+        array_path = os.path.join(cache_path, '{}.npy'.format(idx))
+        try:
+            values = np.load(array_path, mmap_mode='r')
+        except ValueError:
+            # empty arrays cannot be memory-mapped
+            values = np.load(array_path)
+        missing_path = os.path.join(cache_path, '{}_missing.npy'.format(idx))
+        if os.path.exists(missing_path):
+            values = np.where(np.load(missing_path), None, values.astype(object))
+        arrays[str(name)] = values
+    return arrays
+
+
+def _cached_arrays(path, build):
+    """Return the arrays that `build` derives from a CSV file, memory-mapped from a cache.
+
+    Note:
+        On first use the arrays are stored as .npy files in the cache directory, keyed by the
+        hash of the CSV file and the name of `build`. They are then memory-mapped read-only, so
+        the index arrays of all processes (e.g. forked workers) share the same pages. Object
+        arrays (strings) cannot be memory-mapped and are copied on load. If the cache directory
+        is not writable, the arrays are built in memory.
+
+    Arguments:
+        path (:obj:`str`): path of the CSV file
+        build (:obj:`callable`): function of the path that returns a dict of arrays
+
+    Returns:
+        :obj:`dict`: arrays by name
+    """
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read())
+    digest.update('{}:{}'.format(_CACHE_VERSION, build.__name__).encode())
+    name = os.path.splitext(os.path.basename(path))[0]
+    cache_path = os.path.join(_cache_dir(), '{}-{}'.format(name, digest.hexdigest()))
+
+    arrays = None
+    if not os.path.isdir(cache_path):
+        arrays = build(path)
+        try:
+            os.makedirs(_cache_dir(), exist_ok=True)
+            _save_arrays(arrays, cache_path)
+        except OSError:
+            # read-only or missing cache directory, use the arrays without caching them
+            pass
+    try:
+        return _load_arrays(cache_path)
+    except (OSError, ValueError):
+        return arrays if arrays is not None else build(path)
+
+
+def _table_arrays(table, name):
+    """Return the columns of a table as arrays named '<name>/<column>' for :func:`_save_arrays`.
+
+    Note:
+        The column order is stored in '<name>/columns'.
+    """
+    arrays = {'{}/columns'.format(name): np.array(table.columns, dtype=str)}
+    for column in table.columns:
+        arrays['{}/{}'.format(name, column)] = table[column].to_numpy()
+    return arrays
+
+
+def _table_from_arrays(arrays, name, **columns):
+    """Build a table from arrays stored with :func:`_table_arrays`.
+
+    Arguments:
+        columns: values of columns that are not stored as arrays
+    """
+    table = {}
+    for column in arrays['{}/columns'.format(name)]:
+        column = str(column)
+        values = columns[column] if column in columns else arrays['{}/{}'.format(name, column)]
+        if isinstance(values, np.ndarray) and values.dtype == object:
+            values = np.where(pd.isna(values), np.nan, values)
+        table[column] = values
+    return pd.DataFrame(table)
+
+
+def _mapping_key(ferwar, datetimes, origin):
+    offsets = (datetimes - origin) // np.timedelta64(1, 'us')
+    offsets = np.clip(offsets, 0, 2 ** _MAPPING_TIME_BITS - 1)
+    return np.left_shift(ferwar.astype(np.int64), _MAPPING_TIME_BITS) | offsets
+
+
+# The index arrays of each table are built from the CSV file once and cached on disk, see
+# _cached_arrays. The table loaders are cached too, so each table is loaded at most once per
+# process and shared by all BeeMetaInfo instances. Each loader returns the attributes it provides.
+
+def _build_hatchdates(path):
+    hatchdates = pd.read_csv(path)
+    hatchdates.hatchdate = pd.to_datetime(hatchdates.hatchdate, format='%d.%m.%Y')
+
+    # dense arrays indexed by ID so that every lookup is a single array access
+    known_dec12 = np.zeros(4096, dtype=bool)
+    known_dec12[hatchdates.dec12.values] = True
+    hatchdate_by_dec12 = np.full(4096, np.datetime64('NaT'), dtype='datetime64[ns]')
+    hatchdate_by_dec12[hatchdates.dec12.values] = \
+        hatchdates.hatchdate.values.astype('datetime64[ns]')
+
+    return dict(_table_arrays(hatchdates, 'hatchdates'),
+                _known_dec12=known_dec12,
+                _hatchdate_by_dec12=hatchdate_by_dec12)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_hatchdates(path):
+    arrays = _cached_arrays(path, _build_hatchdates)
+    return dict(hatchdates=_table_from_arrays(arrays, 'hatchdates'),
+                _known_dec12=arrays['_known_dec12'],
+                _hatchdate_by_dec12=arrays['_hatchdate_by_dec12'])
+
+
+def _build_foragers(path):
+    foragers = pd.read_csv(path)
+    foragers.date = pd.to_datetime(foragers.date, format='%d.%m.%Y')
+    members = [np.array(ids.split(' '), dtype=np.int64) for ids in foragers.dec12.values]
+
+    group_ids = foragers.group_id.values
+    foragergroup_row_by_id = np.full(group_ids.max() + 1, -1, dtype=np.int64)
+    foragergroup_row_by_id[group_ids[::-1]] = np.arange(len(group_ids))[::-1]
+
+    # inverted index from dec_12 to forager group rows as a sparse boolean ID x group
+    # matrix in CSR format and in dense form for batched queries and set algebra
+    nb_members = np.array([len(ids) for ids in members], dtype=np.int64)
+    member_rows = np.repeat(np.arange(len(foragers)), nb_members)
+    member_dec12 = np.concatenate(members)
+    pairs = np.unique(member_dec12 * len(foragers) + member_rows)
+    unique_dec12, unique_rows = np.divmod(pairs, len(foragers))
+    group_membership = np.zeros((4096, len(foragers)), dtype=bool)
+    group_membership[unique_dec12, unique_rows] = True
+
+    arrays = _table_arrays(foragers.drop(columns='dec12'), 'foragers')
+    # keep the position of the dec12 column, its parsed member lists are stored in CSR format
+    arrays['foragers/columns'] = np.array(foragers.columns, dtype=str)
+    arrays.update(_member_indptr=np.concatenate(([0], np.cumsum(nb_members))),
+                  _member_dec12=member_dec12,
+                  _foragergroup_row_by_id=foragergroup_row_by_id,
+                  _group_indptr=np.concatenate(
+                      ([0], np.cumsum(np.bincount(unique_dec12, minlength=4096)))),
+                  _group_indices=unique_rows,
+                  _group_membership=group_membership)
+    return arrays
+
+
+@functools.lru_cache(maxsize=None)
+def _load_foragers(path):
+    arrays = _cached_arrays(path, _build_foragers)
+    indptr, members = arrays['_member_indptr'], arrays['_member_dec12']
+    dec12 = [members[indptr[row]:indptr[row + 1]].tolist() for row in range(len(indptr) - 1)]
+    return dict(foragers=_table_from_arrays(arrays, 'foragers', dec12=dec12),
+                _foragergroup_row_by_id=arrays['_foragergroup_row_by_id'],
+                _group_indptr=arrays['_group_indptr'],
+                _group_indices=arrays['_group_indices'],
+                _group_membership=arrays['_group_membership'])
+
+
+def _build_beenames(path):
+    beenames = pd.read_csv(path, sep=' ')
+
+    beename_by_ferwar = np.full(4096, None, dtype=object)
+    beename_by_ferwar[beenames.bee_id.values] = beenames.name.values
+
+    return dict(_table_arrays(beenames, 'beenames'),
+                _beename_by_ferwar=beename_by_ferwar)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_beenames(path):
+    arrays = _cached_arrays(path, _build_beenames)
+    return dict(beenames=_table_from_arrays(arrays, 'beenames'),
+                _beename_by_ferwar=arrays['_beename_by_ferwar'])
+
+
+def _build_idmapping(path):
+    idmapping = pd.read_csv(path)
+    idmapping.date = pd.to_datetime(idmapping.date)
+
+    # per-ID sorted change points of the ID mapping in CSR format. For batched lookups, each
+    # change point also gets a single sortable int64 key: the ferwar ID in the upper bits and
+    # the microseconds since the first change point in the lower _MAPPING_TIME_BITS bits.
+    mapping_ids = idmapping.bee_id.values.astype(np.int64)
+    mapping_dates = idmapping.date.values.astype('datetime64[ns]')
+    order = np.lexsort((mapping_dates, mapping_ids))
+    mapping_dates = mapping_dates[order]
+    mapping_origin = mapping_dates.min()
+
+    return dict(_table_arrays(idmapping, 'idmapping'),
+                _mapping_indptr=np.concatenate(
+                    ([0], np.cumsum(np.bincount(mapping_ids, minlength=4096)))),
+                _mapping_dates=mapping_dates,
+                _mapped_ids=idmapping.mapped_id.values[order],
+                _mapping_origin=np.array(mapping_origin),
+                _mapping_keys=_mapping_key(mapping_ids[order], mapping_dates, mapping_origin))
+
+
+@functools.lru_cache(maxsize=None)
+def _load_idmapping(path):
+    arrays = _cached_arrays(path, _build_idmapping)
+    idmapping = _table_from_arrays(arrays, 'idmapping')
+    idmapping.date = idmapping.date.dt.tz_localize('UTC')
+    return dict(idmapping=idmapping,
+                _mapping_indptr=arrays['_mapping_indptr'],
+                _mapping_dates=arrays['_mapping_dates'],
+                _mapped_ids=arrays['_mapped_ids'],
+                _mapping_origin=arrays['_mapping_origin'][()],
+                _mapping_keys=arrays['_mapping_keys'])
+
+
+# loader of each table and the attributes the loader provides
+_TABLES = {
+    'hatchdates': (_load_hatchdates,
+                   ('hatchdates', '_known_dec12', '_hatchdate_by_dec12')),
+    'foragers': (_load_foragers,
+                 ('foragers', '_foragergroup_row_by_id', '_group_indptr', '_group_indices',
+                  '_group_membership')),
+    'beenames': (_load_beenames,
+                 ('beenames', '_beename_by_ferwar')),
+    'idmapping': (_load_idmapping,
+                  ('idmapping', '_mapping_indptr', '_mapping_dates', '_mapped_ids',
+                   '_mapping_origin', '_mapping_keys')),
+}
+_LAZY_ATTRIBUTES = {attribute: table
+                    for table, (_, attributes) in _TABLES.items()
+                    for attribute in attributes}
+# file name prefix of each seasonal table, e.g. foragergroups2016.csv
+_SEASONAL_FILE_PREFIXES = {'hatchdates': 'hatchdates',
+                           'foragergroups': 'foragers',
+                           'idmapping': 'idmapping'}
+_shared_instance = None
+
+
+class SeasonRegistry:
+    """Registry of the meta information tables available for each season.
+
+    Note:
+        Seasons are identified by their year. Each season can provide a hatchdates, foragers and
+        idmapping table in the format of the bundled files. The bee names do not depend on the
+        season.
+
+    Arguments:
+        beenames (:obj:`str`): (optional) path of the bee names table, the bundled one by default
+    """
+
+    def __init__(self, beenames=None):
+        self.beenames = beenames
+        self._paths = {}
+
+    def register(self, season, hatchdates=None, foragers=None, idmapping=None):
+        """Register the tables of a season.
+
+        Arguments:
+            season (:obj:`int`): year of the season
+            hatchdates (:obj:`str`): (optional) path of the hatchdates table
+            foragers (:obj:`str`): (optional) path of the forager groups table
+            idmapping (:obj:`str`): (optional) path of the ID mapping table
+        """
+        for table, path in (('hatchdates', hatchdates),
+                            ('foragers', foragers),
+                            ('idmapping', idmapping)):
+            if path is not None:
+                self._paths[(table, season)] = path
+
+    def register_directory(self, path):
+        """Register all tables in a directory that are named like the bundled files.
+
+        Note:
+            Files are expected to be named hatchdates<year>.csv, foragergroups<year>.csv and
+            idmapping<year>.csv, other files are ignored.
+
+        Arguments:
+            path (:obj:`str`): directory with meta information tables
+        """
+        for filename in sorted(os.listdir(path)):
+            match = re.match(r'^({})(\d{{4}})\.csv$'.format('|'.join(_SEASONAL_FILE_PREFIXES)),
+                             filename)
+            if match is not None:
+                table = _SEASONAL_FILE_PREFIXES[match.group(1)]
+                self.register(int(match.group(2)), **{table: os.path.join(path, filename)})
+
+    def seasons(self, table):
+        """Return the sorted seasons for which the given table is registered."""
+        return sorted(season for (registered_table, season) in self._paths
+                      if registered_table == table)
+
+    def get_path(self, table, season):
+        """Return the path of a table for the given season.
+
+        Raises:
+            ValueError: if the table is not registered for the season
+        """
+        if table == 'beenames':
+            return self.beenames if self.beenames is not None else _data_path('beenames.csv')
+        if (table, season) not in self._paths:
+            raise ValueError('Meta information only available for seasons {}'.format(
+                self.seasons(table)))
+        return self._paths[(table, season)]
+
+
+@functools.lru_cache(maxsize=None)
+def _bundled_registry():
+    registry = SeasonRegistry()
+    registry.register(2016,
+                      hatchdates=_data_path('hatchdates2016.csv'),
+                      foragers=_data_path('foragergroups2016.csv'))
+    registry.register(2019, idmapping=_data_path('idmapping2019.csv'))
+    return registry
 
 
 class BeeMetaInfo:
-    def __init__(self):
-        hatchdates_path = pkg_resources.resource_filename('bb_utils', 'data/hatchdates2016.csv')
-        self.hatchdates = pd.read_csv(hatchdates_path)
-        self.hatchdates.hatchdate = pd.to_datetime(self.hatchdates.hatchdate, format='%d.%m.%Y')
+    """Meta information about the bees of all registered seasons.
+
+    Note:
+        Queries with timestamps use the tables of the timestamp's season, batched queries route
+        each row to its season. Queries without timestamps use the tables of `season`.
+
+        Tables are loaded lazily on first access. Parsed tables and their lookup structures are
+        cached and shared by all instances in a process, so constructing instances is free.
+
+    Arguments:
+        registry (:class:`.SeasonRegistry`): (optional) registry of the available tables, the
+            bundled tables (hatchdates and forager groups of 2016, ID mapping of 2019) by default
+        season (:obj:`int`): (optional) season of queries without timestamps, the latest
+            registered season of each table by default
+    """
+
+    def __init__(self, registry=None, season=None):
+        self.registry = registry if registry is not None else _bundled_registry()
+        self.season = season
+
+    @classmethod
+    def shared(cls):
+        """Return a process-wide shared instance."""
+        global _shared_instance
+        if _shared_instance is None:
+            _shared_instance = cls()
+        return _shared_instance
+
+    def __getattr__(self, name):
+        # only called for attributes that have not been loaded into this instance yet
+        table = _LAZY_ATTRIBUTES.get(name)
+        if table is None:
+            raise AttributeError(name)
+        attributes = self._season_attributes(table, self._default_season(table))
+        self.__dict__.update(attributes)
+        return attributes[name]
+
+    def _default_season(self, table):
+        if self.season is not None or table == 'beenames':
+            return self.season
+        seasons = self.registry.seasons(table)
+        if len(seasons) == 0:
+            raise ValueError('No season with {} registered'.format(table))
+        return seasons[-1]
 
-        foragers_path = pkg_resources.resource_filename('bb_utils', 'data/foragergroups2016.csv')
-        self.foragers = pd.read_csv(foragers_path)
-        self.foragers.date = pd.to_datetime(self.foragers.date, format='%d.%m.%Y')
-        self.foragers.dec12 = self.foragers.dec12.apply(lambda ids: list(map(int, ids.split(' '))))
+    def _season_attributes(self, table, season):
+        loader, _ = _TABLES[table]
+        return loader(self.registry.get_path(table, season))
 
-        beenames_path = pkg_resources.resource_filename('bb_utils', 'data/beenames.csv')
-        self.beenames = pd.read_csv(beenames_path, sep=' ')
+    def _season_indices(self, table, datetimes):
+        """Return index of each timestamp's season in the registered seasons, or the number of
+        registered seasons for timestamps of unregistered seasons."""
+        seasons = np.array(self.registry.seasons(table), dtype=np.int64)
+        years = datetimes.astype('datetime64[Y]').astype(np.int64) + 1970
+        if len(seasons) == 0:
+            return np.zeros(len(years), dtype=np.int64)
+        indices = np.minimum(np.searchsorted(seasons, years), len(seasons) - 1)
+        return np.where(seasons[indices] == years, indices, len(seasons))
 
-        idmapping_path = pkg_resources.resource_filename('bb_utils', 'data/idmapping2019.csv')
-        self.idmapping = pd.read_csv(idmapping_path, parse_dates=['date'])
-        self.idmapping.date = self.idmapping.date.dt.tz_localize('UTC')
+    def _seasonal_index(self, table, build):
+        # rebuilt if seasons have been registered since it was built
+        seasons = tuple(self.registry.seasons(table))
+        cached = self.__dict__.get('_seasonal_index_' + table)
+        if cached is None or cached[0] != seasons:
+            cached = (seasons, build([self._season_attributes(table, season)
+                                      for season in seasons]))
+            self.__dict__['_seasonal_index_' + table] = cached
+        return cached[1]
 
-    def _check_date(self, timestamp, check_year=2016):
-        if timestamp.year != check_year:
-            raise ValueError('Meta information only available for season {}'.format(check_year))
+    def _seasonal_hatchdates(self):
+        def build(seasons):
+            # [number of seasons + 1, 4096], the last row is NaT for unregistered seasons
+            rows = [attributes['_hatchdate_by_dec12'] for attributes in seasons]
+            rows.append(np.full(4096, np.datetime64('NaT'), dtype='datetime64[ns]'))
+            return np.stack(rows)
+        return self._seasonal_index('hatchdates', build)
+
+    def _seasonal_idmapping(self):
+        def build(seasons):
+            # concatenation of the change points of all seasons, sorted by their keys
+            offsets = np.cumsum([0] + [len(attributes['_mapping_dates']) for attributes in seasons])
+            return dict(
+                keys=np.concatenate(
+                    [np.left_shift(np.int64(idx), _MAPPING_SEASON_SHIFT) | a['_mapping_keys']
+                     for idx, a in enumerate(seasons)] + [np.zeros(0, dtype=np.int64)]),
+                dates=np.concatenate([a['_mapping_dates'] for a in seasons] +
+                                     [np.zeros(0, dtype='datetime64[ns]')]),
+                mapped_ids=np.concatenate([a['_mapped_ids'] for a in seasons] +
+                                          [np.zeros(0, dtype=np.int64)]),
+                starts=np.array([a['_mapping_indptr'][:-1] + offset
+                                 for a, offset in zip(seasons, offsets)]).reshape(-1, 4096),
+                origins=np.array([a['_mapping_origin'] for a in seasons],
+                                 dtype='datetime64[ns]'))
+        return self._seasonal_index('idmapping', build)
+
+    def _get_hatchdate(self, bee_id, season):
+        assert(type(bee_id) is BeesbookID)
+        attributes = self._season_attributes('hatchdates', season)
+        dec12 = bee_id.as_dec_12()
+        if not attributes['_known_dec12'][dec12]:
+            raise ValueError('Unknown ID {}'.format(bee_id))
+        return pd.Timestamp(attributes['_hatchdate_by_dec12'][dec12])
 
     def get_hatchdate(self, bee_id):
         """Get hatchdate of the bee with the given ID.
@@ -36,11 +497,7 @@ class BeeMetaInfo:
         Returns:
             :class:`datetime.dateime`: hatchdate of the bee
         """
-        assert(type(bee_id) is BeesbookID)
-        indices = np.where(self.hatchdates.dec12 == bee_id.as_dec_12())[0]
-        if len(indices) == 0:
-            raise ValueError('Unknown ID {}'.format(bee_id))
-        return pd.to_datetime(self.hatchdates.iloc[indices[0]].hatchdate)
+        return self._get_hatchdate(bee_id, self._default_season('hatchdates'))
 
     def get_group_memberships(self, bee_id):
         """Get forager groups of the bee with the given ID.
@@ -52,11 +509,78 @@ class BeeMetaInfo:
             :[int]: list of forager group ids
         """
         assert(type(bee_id) is BeesbookID)
-        groups = []
-        for row in self.foragers.iterrows():
-            if bee_id.as_dec_12() in row[1].dec12:
-                groups.append(row[1].group_id)
-        return groups
+        dec12 = bee_id.as_dec_12()
+        rows = self._group_indices[self._group_indptr[dec12]:self._group_indptr[dec12 + 1]]
+        return self.foragers.group_id.values[rows].tolist()
+
+    def get_group_membership_matrix(self, bee_ids, representation='dec_12'):
+        """Get forager group memberships of the bees with the given IDs.
+
+        Arguments:
+            bee_ids: IDs as array, :class:`pd.Series` or :class:`.BeesbookIDArray`
+            representation (:obj:`str`): representation of the IDs
+
+        Returns:
+            :obj:`np.array`: boolean matrix with shape [len(bee_ids), number of groups], columns
+            are in the order of `self.foragers.group_id`. A :class:`pd.DataFrame` with group IDs
+            as columns is returned for :class:`pd.Series` inputs.
+        """
+        dec12 = _as_id_array(bee_ids, representation).as_dec_12()
+        memberships = self._group_membership[dec12]
+        if isinstance(bee_ids, pd.Series):
+            return pd.DataFrame(memberships, index=bee_ids.index,
+                                columns=self.foragers.group_id.values)
+        return memberships
+
+    def _group_rows(self, group_ids):
+        group_ids = np.atleast_1d(group_ids)
+        if np.any((group_ids < 0) | (group_ids >= len(self._foragergroup_row_by_id))):
+            raise ValueError('Unknown ID in {}'.format(group_ids))
+        rows = self._foragergroup_row_by_id[group_ids]
+        if np.any(rows < 0):
+            raise ValueError('Unknown ID in {}'.format(group_ids))
+        return rows
+
+    def get_group_members(self, group_ids, how='all'):
+        """Get the bees that are members of all (or any) of the given forager groups.
+
+        Arguments:
+            group_ids ([int]): Group IDs
+            how (:obj:`str`): 'all' for the intersection, 'any' for the union of the groups
+
+        Returns:
+            :class:`.BeesbookIDArray`: sorted IDs of the matching bees
+        """
+        if how not in ('all', 'any'):
+            raise ValueError("how must be 'all' or 'any'")
+        columns = self._group_membership[:, self._group_rows(group_ids)]
+        selected = columns.all(axis=1) if how == 'all' else columns.any(axis=1)
+        return BeesbookIDArray(np.flatnonzero(selected))
+
+    def get_group_overlaps(self):
+        """Get the number of bees shared by each pair of forager groups.
+
+        Returns:
+            :class:`pd.DataFrame`: symmetric matrix of shared bee counts indexed by group ID
+        """
+        membership = self._group_membership.astype(np.int32)
+        group_ids = self.foragers.group_id.values
+        return pd.DataFrame(membership.T.dot(membership), index=group_ids, columns=group_ids)
+
+    def get_groups_sharing_bees(self, group_id):
+        """Get the forager groups that share at least one bee with the given group.
+
+        Arguments:
+            group_id (:int:): Group ID
+
+        Returns:
+            :[int]: list of forager group ids, excluding the given group
+        """
+        row = self._group_rows(group_id)[0]
+        members = self._group_membership[:, row]
+        shared = self._group_membership[members].any(axis=0)
+        shared[row] = False
+        return self.foragers.group_id.values[shared].tolist()
 
     def get_foragergroup(self, group_id):
         """Get metainformation for a specific forager group.
@@ -67,10 +591,10 @@ class BeeMetaInfo:
         Returns:
             :class:`pd.Series`: forager group metainformation
         """
-        indices = np.where(self.foragers.group_id == group_id)[0]
-        if len(indices) == 0:
+        if not 0 <= group_id < len(self._foragergroup_row_by_id) or \
+                self._foragergroup_row_by_id[group_id] < 0:
             raise ValueError('Unknown ID {}'.format(group_id))
-        return self.foragers.iloc[indices[0]]
+        return self.foragers.iloc[self._foragergroup_row_by_id[group_id]]
 
     def has_hatched(self, bee_id, timestamp):
         """Check whether a bee has already hatched given a timestamp and ID.
@@ -82,9 +606,7 @@ class BeeMetaInfo:
         Returns:
             :bool: True if bee has hatched before the given timestamp
         """
-        self._check_date(timestamp)
-
-        bee_hatchdate = self.get_hatchdate(bee_id)
+        bee_hatchdate = self._get_hatchdate(bee_id, timestamp.year)
         return timestamp >= bee_hatchdate
 
     def get_age(self, bee_id, timestamp):
@@ -97,9 +619,7 @@ class BeeMetaInfo:
         Returns:
             :class:`datetime.timedelta` Age of the bee at the given timestamp
         """
-        self._check_date(timestamp)
-
-        bee_hatchdate = self.get_hatchdate(bee_id)
+        bee_hatchdate = self._get_hatchdate(bee_id, timestamp.year)
         return timestamp - bee_hatchdate
 
     def get_beename(self, bee_id):
@@ -110,7 +630,10 @@ class BeeMetaInfo:
         Returns:
             :class:`str` Name of the bee with the given ID
         """
-        return self.beenames[self.beenames.bee_id == bee_id.as_ferwar()].name.values[0]
+        name = self._beename_by_ferwar[bee_id.as_ferwar()]
+        if name is None:
+            raise ValueError('Unknown ID {}'.format(bee_id))
+        return name
 
     def get_mapped_id(self, bee_id, timestamp):
         """
@@ -123,8 +646,120 @@ class BeeMetaInfo:
         Returns:
             :class:`int` Original ID in ferwar format for IDs that don't need mapping, mapped ID otherwise
         """
-        self._check_date(timestamp, check_year=2019)
+        attributes = self._season_attributes('idmapping', timestamp.year)
+
+        ferwar = bee_id.as_ferwar()
+        indptr = attributes['_mapping_indptr']
+        start, end = indptr[ferwar], indptr[ferwar + 1]
+        index = np.searchsorted(attributes['_mapping_dates'][start:end],
+                                to_naive_utc_datetime64(timestamp)[0], side='right') - 1
+        if index < 0:
+            raise ValueError('No mapping for ID {} at {}'.format(bee_id, timestamp))
+        return attributes['_mapped_ids'][start + index]
+
+    def get_hatchdates(self, bee_ids, representation='dec_12', season=None):
+        """Get hatchdates of the bees with the given IDs.
+
+        Note:
+            All batch queries accept a :class:`pd.Series` in place of an array and then return
+            a :class:`pd.Series` with the same index, so they can be used to annotate the
+            columns of a detections DataFrame in a single vectorized pass.
+
+        Arguments:
+            bee_ids: IDs as array, :class:`pd.Series` or :class:`.BeesbookIDArray`
+            representation (:obj:`str`): representation of the IDs, see
+                :meth:`.BeesbookID.batch_convert`
+            season (:obj:`int`): (optional) season of the hatchdates, the default season of
+                this instance if not given
+
+        Returns:
+            :obj:`np.array`: datetime64 hatchdates, NaT for unknown hatchdates
+        """
+        season = self._default_season('hatchdates') if season is None else season
+        hatchdate_by_dec12 = self._season_attributes('hatchdates', season)['_hatchdate_by_dec12']
+        dec12 = _as_id_array(bee_ids, representation).as_dec_12()
+        return _like_input(hatchdate_by_dec12[dec12], bee_ids)
+
+    def have_hatched(self, bee_ids, timestamps, representation='dec_12'):
+        """Check whether bees have already hatched given arrays of timestamps and IDs.
+
+        Arguments:
+            bee_ids: IDs as array, :class:`pd.Series` or :class:`.BeesbookIDArray`
+            timestamps: array or :class:`pd.Series` of timestamps
+            representation (:obj:`str`): representation of the IDs
+
+        Returns:
+            :obj:`np.array`: True for bees that have hatched before the given timestamps, False
+            for unknown hatchdates and timestamps of unregistered seasons
+        """
+        datetimes = to_naive_utc_datetime64(timestamps)
+        dec12 = _as_id_array(bee_ids, representation).as_dec_12()
+        hatchdates = self._seasonal_hatchdates()[self._season_indices('hatchdates', datetimes),
+                                                 dec12]
+        return _like_input(datetimes >= hatchdates, bee_ids, timestamps)
+
+    def get_ages(self, bee_ids, timestamps, representation='dec_12'):
+        """Get ages of bees given arrays of timestamps and IDs.
+
+        Arguments:
+            bee_ids: IDs as array, :class:`pd.Series` or :class:`.BeesbookIDArray`
+            timestamps: array or :class:`pd.Series` of timestamps
+            representation (:obj:`str`): representation of the IDs
+
+        Returns:
+            :obj:`np.array`: timedelta64 ages of the bees, NaT for unknown hatchdates and
+            timestamps of unregistered seasons
+        """
+        datetimes = to_naive_utc_datetime64(timestamps)
+        dec12 = _as_id_array(bee_ids, representation).as_dec_12()
+        hatchdates = self._seasonal_hatchdates()[self._season_indices('hatchdates', datetimes),
+                                                 dec12]
+        return _like_input(datetimes - hatchdates, bee_ids, timestamps)
+
+    def get_beenames(self, bee_ids, representation='dec_12'):
+        """Return the Beename-Char-RNN generated names for the given IDs.
+
+        Arguments:
+            bee_ids: IDs as array, :class:`pd.Series` or :class:`.BeesbookIDArray`
+            representation (:obj:`str`): representation of the IDs
+
+        Returns:
+            :obj:`np.array`: object array of names, None for unknown IDs
+        """
+        ferwar = _as_id_array(bee_ids, representation).as_ferwar()
+        return _like_input(self._beename_by_ferwar[ferwar], bee_ids)
+
+    def get_mapped_ids(self, bee_ids, timestamps, representation='dec_12'):
+        """Return the mapped IDs given arrays of timestamps and IDs.
+
+        Arguments:
+            bee_ids: IDs as array, :class:`pd.Series` or :class:`.BeesbookIDArray`
+            timestamps: array or :class:`pd.Series` of timestamps, naive timestamps are
+                interpreted as UTC
+            representation (:obj:`str`): representation of the IDs
+
+        Returns:
+            :obj:`np.array`: original IDs in ferwar format for IDs that don't need mapping,
+            mapped IDs otherwise, -1 for timestamps before the first mapping of an ID and for
+            timestamps of seasons without ID mapping
+        """
+        datetimes = to_naive_utc_datetime64(timestamps)
+        ferwar = _as_id_array(bee_ids, representation).as_ferwar().astype(np.int64)
+        ferwar, datetimes = np.broadcast_arrays(ferwar, datetimes)
+
+        index = self._seasonal_idmapping()
+        if len(index['dates']) == 0:
+            return _like_input(np.full(len(ferwar), -1, dtype=np.int64), bee_ids, timestamps)
+        seasons = self._season_indices('idmapping', datetimes)
+        known_season = seasons < len(index['origins'])
+        seasons = np.minimum(seasons, len(index['origins']) - 1)
 
-        mapped = self.idmapping[self.idmapping.bee_id == bee_id.as_ferwar()]
-        mapped = mapped[mapped.date <= timestamp]
-        return mapped.iloc[-1].mapped_id
\ No newline at end of file
+        keys = np.left_shift(seasons, _MAPPING_SEASON_SHIFT) | \
+            _mapping_key(ferwar, datetimes, index['origins'][seasons])
+        indices = np.searchsorted(index['keys'], keys, side='right') - 1
+        # the key of the preceding change point may belong to a different ID or lie after the
+        # timestamp if the timestamp was clipped to the start of its season
+        indices = np.maximum(indices, 0)
+        valid = known_season & (indices >= index['starts'][seasons, ferwar]) & \
+            (index['dates'][indices] <= datetimes)
+        return _like_input(np.where(valid, index['mapped_ids'][indices], -1), bee_ids, timestamps)
@@ -11,24 +11,15 @@ from diktya.numpy import tile, image_save
 from diktya.distributions import DistributionCollection, Bernoulli
 from deepdecoder.data import DistributionHDF5Dataset
 import click
+import functools
+import multiprocessing
 import os
+import queue
+from concurrent.futures import ProcessPoolExecutor
 from scipy.misc import imread
 from datetime import timedelta
 
 
-class GTPeriod:
-    def __init__(self, camIdx, start, end, filename, frames):
-        self.camIdx = camIdx
-        self.start = start
-        self.end = end
-        self.filename = filename
-        self.frames = frames
-
-    def pickle_filename(self):
-        basename, ext = os.path.splitext(os.path.basename(self.filename))
-        return basename + ".pickle"
-
-
 def get_subdirs(dir):
     return listdir(dir, os.path.isdir)
 
@@ -81,13 +72,141 @@ class FrameGeneratorFactory():
             raise Exception("Unknown source: {}".format(source_type))
 
 
-def append_gt_to_hdf5(gt_period, dset):
-    for gt_frame in gt_period.frames:
-        h5_frame = {k: v for k, v in gt_frame.items() if type(v) == np.ndarray}
-        dist = dset.get_tag_distribution()
-        labels = np.zeros((len(h5_frame['bits']),), dtype=dist.norm_dtype)
-        labels['bits'] = h5_frame.pop('bits')
-        dset.append(labels=labels, **h5_frame)
+def append_batch_to_hdf5(batch, dset):
+    batch = dict(batch)
+    dist = dset.get_tag_distribution()
+    labels = np.zeros((len(batch['bits']),), dtype=dist.norm_dtype)
+    labels['bits'] = batch.pop('bits')
+    dset.append(labels=labels, **batch)
+
+
+@functools.lru_cache(maxsize=1)
+def id_bits_table():
+    """
+    Returns the bits of all 12 bit ids as used in the hdf5 file, i.e.
+    ``2*int_id_to_binary(id)[::-1] - 1`` for every id, as a (4096, 12) array.
+    """
+    return 2*np.array([int_id_to_binary(id)[::-1] for id in range(2**12)], dtype=float) - 1
+
+
+def get_period(fname, fix_utc_2014):
+    camIdx, start_dt, end_dt = parse_video_fname(fname)
+    if fix_utc_2014 and start_dt.year == 2014:
+        start_dt -= timedelta(hours=2)
+    return camIdx, start_dt, end_dt
+
+
+def concat_gt_frames(gt_frames):
+    return {name: np.concatenate([gt[name] for gt in gt_frames])
+            for name in gt_frames[0].keys()}
+
+
+def gt_batches(fname, gen_factory, fix_utc_2014, batch_size, stop_event=None):
+    """
+    Yields the ground truth of a bb_binary file together with the extracted
+    rois in batches of ``batch_size`` frames. Stops early once ``stop_event``
+    is set.
+    """
+    fc = load_frame_container(fname)
+    camIdx, start_dt, end_dt = get_period(fname, fix_utc_2014)
+    bits_table = id_bits_table()
+    gt_frames = []
+    gen = gen_factory.get_generator(camIdx, start_dt)
+    for frame, (video_frame, video_filename) in zip(fc.frames, gen):
+        if stop_event is not None and stop_event.is_set():
+            return
+        gt = {}
+        np_frame = convert_frame_to_numpy(frame)
+        rois, mask, positions = extract_gt_rois(np_frame, video_frame, start_dt)
+        for name in np_frame.dtype.names:
+            gt[name] = np_frame[name][mask]
+        gt["bits"] = bits_table[gt["decodedId"]]
+        gt["tags"] = 2 * (rois / 255.).astype(np.float16) - 1
+        gt_frames.append(gt)
+        if len(gt_frames) == batch_size:
+            yield concat_gt_frames(gt_frames)
+            gt_frames = []
+    if gt_frames:
+        yield concat_gt_frames(gt_frames)
+
+
+# State of the worker processes, set by _init_worker.
+_worker_queue = None
+_worker_gen_factory = None
+_worker_stop_event = None
+
+
+def _init_worker(batch_queue, gen_factory, stop_event):
+    global _worker_queue, _worker_gen_factory, _worker_stop_event
+    _worker_queue = batch_queue
+    _worker_gen_factory = gen_factory
+    _worker_stop_event = stop_event
+
+
+def _extract_gt_file(file_idx, fname, fix_utc_2014, batch_size):
+    """
+    Puts the batches of one gt file into the bounded queue of the writer,
+    followed by ``(file_idx, None)`` when the file is done (also on errors).
+    """
+    try:
+        for batch in gt_batches(fname, _worker_gen_factory, fix_utc_2014, batch_size,
+                                _worker_stop_event):
+            _worker_queue.put((file_idx, batch))
+    finally:
+        _worker_queue.put((file_idx, None))
+
+
+def write_gt_batches(gt_files, gen_factory, dset, fix_utc_2014, batch_size,
+                     queue_depth, workers):
+    """
+    Extracts the gt files in a process pool and appends their batches to
+    ``dset`` from this (single writer) process. At most ``queue_depth``
+    batches wait for the writer, which bounds the memory usage.
+
+    The batches of different files are interleaved in ``dset``. Therefore,
+    every row gets the index of its file in ``gt_files`` in the ``file_idx``
+    dataset.
+    """
+    ctx = multiprocessing.get_context()
+    batch_queue = ctx.Queue(maxsize=queue_depth)
+    stop_event = ctx.Event()
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                                   initializer=_init_worker,
+                                   initargs=(batch_queue, gen_factory, stop_event))
+    futures = [executor.submit(_extract_gt_file, file_idx, fname, fix_utc_2014, batch_size)
+               for file_idx, fname in enumerate(gt_files)]
+    try:
+        nb_done = 0
+        while nb_done < len(futures):
+            try:
+                file_idx, batch = batch_queue.get(timeout=1)
+            except queue.Empty:
+                # A crashed worker never sends its sentinel.
+                for future in futures:
+                    if future.done() and future.exception() is not None:
+                        raise future.exception()
+                continue
+            if batch is None:
+                nb_done += 1
+                # Re-raises the exception of a failed file.
+                futures[file_idx].result()
+            else:
+                batch['file_idx'] = np.full(len(batch['bits']), file_idx, dtype=np.int32)
+                append_batch_to_hdf5(batch, dset)
+                print('.', end='', flush=True)
+        print()
+    finally:
+        # Lets running workers stop after their current frame.
+        stop_event.set()
+        for future in futures:
+            future.cancel()
+        # Workers might block on the full queue after an error.
+        while not all(future.done() for future in futures):
+            try:
+                batch_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        executor.shutdown()
 
 
 @click.command("bb_gt_to_hdf5")
@@ -97,11 +216,23 @@ def append_gt_to_hdf5(gt_period, dset):
 @click.option('--images', '-i', help='file with image directories', type=click.File(), required=False)
 @click.option('--visualize-debug', is_flag=True)
 @click.option('--fix-utc-2014', type=bool, default=True)
+@click.option('--workers', '-j', type=int, default=None,
+              help='number of processes that decode videos and extract rois')
+@click.option('--batch-size', default=32, type=int,
+              help='number of frames that are appended to the hdf5 file at once')
+@click.option('--queue-depth', default=8, type=int,
+              help='maximum number of batches waiting to be written')
 @click.argument('output')
-def run(gt_file, videos, images, visualize_debug, output, fix_utc_2014, nb_bits=12):
+def run(gt_file, videos, images, visualize_debug, output, fix_utc_2014,
+        workers, batch_size, queue_depth, nb_bits=12):
     """
     Converts bb_binary ground truth Cap'n Proto files to hdf5 files and
     extracts the corresponding rois from videos or images.
+
+    The gt files are processed in parallel by a pool of processes and their
+    batches are appended to the hdf5 file by a single writer. The
+    ``file_idx`` dataset maps every row to its entry in the ``periods`` and
+    ``camIdxs`` attributes.
     """
     def get_filenames(f):
         if f is None:
@@ -116,34 +247,15 @@ def run(gt_file, videos, images, visualize_debug, output, fix_utc_2014, nb_bits=
 
     distribution = DistributionCollection([('bits', Bernoulli(), nb_bits)])
     dset = DistributionHDF5Dataset(output, distribution)
+    write_gt_batches(gt_file, gen_factory, dset, fix_utc_2014, batch_size,
+                     queue_depth, workers)
+
     camIdxs = []
     periods = []
     for fname in gt_file:
-        fc = load_frame_container(fname)
-        camIdx, start_dt, end_dt = parse_video_fname(fname)
-        if fix_utc_2014 and start_dt.year == 2014:
-            start_dt -= timedelta(hours=2)
-        gt_frames = []
-        gen = gen_factory.get_generator(camIdx, start_dt)
-        for frame, (video_frame, video_filename) in zip(fc.frames, gen):
-            gt = {}
-            np_frame = convert_frame_to_numpy(frame)
-            rois, mask, positions = extract_gt_rois(np_frame, video_frame, start_dt)
-            for name in np_frame.dtype.names:
-                gt[name] = np_frame[name][mask]
-            bits = [int_id_to_binary(id)[::-1] for id in gt["decodedId"]]
-            gt["bits"] = 2*np.array(bits, dtype=float) - 1
-            gt["tags"] = 2 * (rois / 255.).astype(np.float16) - 1
-            gt['filename'] = os.path.basename(video_filename)
-            gt['camIdx'] = camIdx
-            gt_frames.append(gt)
-            print('.', end='', flush=True)
-        print()
-        gt_period = GTPeriod(camIdx, start_dt, end_dt, fname, gt_frames)
-
-        periods.append([int(gt_period.start.timestamp()), int(gt_period.end.timestamp())])
-        camIdxs.append(gt_period.camIdx)
-        append_gt_to_hdf5(gt_period, dset)
+        camIdx, start_dt, end_dt = get_period(fname, fix_utc_2014)
+        periods.append([int(start_dt.timestamp()), int(end_dt.timestamp())])
+        camIdxs.append(camIdx)
 
     dset.attrs['periods'] = np.array(periods)
     dset.attrs['camIdxs'] = np.array(camIdxs)
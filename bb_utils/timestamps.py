@@ -0,0 +1,36 @@
+import datetime
+
+import numpy as np
+
+
+def _naive_utc(timestamp):
+    if isinstance(timestamp, datetime.datetime) and timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    # pandas Timestamps keep their nanoseconds this way
+    if hasattr(timestamp, 'to_datetime64'):
+        return timestamp.to_datetime64()
+    return timestamp
+
+
+def to_naive_utc_datetime64(timestamps):
+    """Convert timestamps to a naive datetime64[ns] array in UTC.
+
+    Note:
+        Accepts datetime64 values, :obj:`datetime.datetime` objects, pandas Timestamps, ISO
+        8601 strings and array-likes of them (including pandas Series and DatetimeIndex).
+        Timezone-aware timestamps are converted to UTC; naive ones are assumed to be in UTC
+        already.
+
+    Arguments:
+        timestamps: a single timestamp or an array-like of timestamps
+
+    Returns:
+        :obj:`np.array`: datetime64[ns] array with at least one dimension
+    """
+    timestamps = np.asarray(timestamps)
+    if timestamps.ndim == 0:
+        timestamps = timestamps[None]
+    if timestamps.dtype == object:
+        timestamps = np.array([_naive_utc(t) for t in timestamps.ravel()],
+                              dtype=object).reshape(timestamps.shape)
+    return timestamps.astype('datetime64[ns]')
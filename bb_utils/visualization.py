@@ -1,8 +1,111 @@
+import functools
+import struct
+import zlib
+
 import numpy as np
 from io import BytesIO
 from more_itertools import pairwise
 
 
+# labels of the non-segment regions in a tag label map, labels 0-11 are the bit segments
+_BACKGROUND, _TAG, _INNER_WHITE, _INNER_BLACK, _GUIDELINE = range(12, 17)
+
+
+@functools.lru_cache(maxsize=32)
+def _tag_label_map(surface_width, surface_height, tag_radius, inner_radius, outer_radius,
+                   guideline_width):
+    """Return the cached, unrotated label map of :func:`_compute_tag_label_map`."""
+    return _compute_tag_label_map(surface_width, surface_height, tag_radius, inner_radius,
+                                  outer_radius, guideline_width)
+
+
+def _compute_tag_label_map(surface_width, surface_height, tag_radius, inner_radius,
+                           outer_radius, guideline_width, rotation=0.):
+    """Compute the region label of each pixel of a tag image with the geometry of TagArtist.draw.
+
+    Note:
+        Coordinates are in units of the surface size with angles increasing clockwise from the
+        3 o'clock position, as in cairo. The tag is rotated clockwise by `rotation` radians.
+        Guidelines are at least one pixel wide.
+    """
+    x = (np.arange(surface_width) + .5) / surface_width - .5
+    y = (np.arange(surface_height) + .5) / surface_height - .5
+    x, y = np.meshgrid(x, y)
+    if rotation != 0.:
+        x, y = (x * np.cos(rotation) + y * np.sin(rotation),
+                y * np.cos(rotation) - x * np.sin(rotation))
+    radius = np.hypot(x, y)
+    theta = np.mod(np.arctan2(y, x), 2 * np.pi)
+    half_width = max(guideline_width / 2, .5 / min(surface_width, surface_height))
+
+    labels = np.full((surface_height, surface_width), _BACKGROUND, dtype=np.uint8)
+    labels[radius <= tag_radius] = _TAG
+    in_crown = radius <= outer_radius
+    segments = np.minimum((theta / (2 * np.pi / 12)).astype(np.uint8), 11)
+    labels[in_crown] = segments[in_crown]
+
+    for theta_start in np.linspace(0, 2 * np.pi, num=12, endpoint=False):
+        along = x * np.cos(theta_start) + y * np.sin(theta_start)
+        across = np.abs(y * np.cos(theta_start) - x * np.sin(theta_start))
+        labels[(along >= 0) & (along <= outer_radius) & (across < half_width)] = _GUIDELINE
+    labels[np.abs(radius - outer_radius) < half_width] = _GUIDELINE
+
+    in_inner = radius <= inner_radius
+    labels[in_inner & (y < 0)] = _INNER_WHITE
+    labels[in_inner & (y >= 0)] = _INNER_BLACK
+    labels[np.abs(radius - inner_radius) < half_width] = _GUIDELINE
+
+    labels.setflags(write=False)
+    return labels
+
+
+def _tag_palette(bits_12, background):
+    """Return the [N, 17] gray value of each label of a tag label map for a batch of IDs."""
+    bits = np.roll(np.round(np.atleast_2d(bits_12)).astype(np.uint8), -3, axis=1)
+
+    palette = np.empty((len(bits), 17), dtype=np.uint8)
+    palette[:, :12] = bits * 255
+    palette[:, _BACKGROUND] = background
+    palette[:, _TAG] = 255
+    palette[:, _INNER_WHITE] = 255
+    palette[:, _INNER_BLACK] = 0
+    palette[:, _GUIDELINE] = 128
+    return palette
+
+
+def _encode_png(image):
+    """Encode a grayscale [H, W] uint8 image as PNG."""
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + \
+            struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width = image.shape
+    # every scanline starts with filter type 0 (none)
+    scanlines = np.zeros((height, width + 1), dtype=np.uint8)
+    scanlines[:, 1:] = image
+    return b'\x89PNG\r\n\x1a\n' + \
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(scanlines.tobytes())) + \
+        chunk(b'IEND', b'')
+
+
+def _bits_to_dec_12(bits_12):
+    return int(np.dot(np.round(bits_12).astype(np.int64), np.left_shift(1, np.arange(11, -1, -1))))
+
+
+def _dec_12_to_bits(dec_12):
+    return np.right_shift(np.asarray(dec_12)[..., None], np.arange(11, -1, -1)) & 1
+
+
+@functools.lru_cache(maxsize=1024)
+def _draw_cached(dec_12, surface_width, surface_height, tag_radius, background_color,
+                 guideline_width):
+    artist = TagArtist(surface_width, surface_height, tag_radius, background_color,
+                       guideline_width)
+    return artist.draw(_dec_12_to_bits(dec_12))
+
+
 class TagArtist:
     def __init__(self,
                  surface_width=256,
@@ -18,6 +121,130 @@ class TagArtist:
         self.background_color = background_color
         self.guideline_width = guideline_width
 
+    def _label_map(self):
+        return _tag_label_map(self.surface_width, self.surface_height, self.tag_radius,
+                              self.inner_radius, self.outer_radius, self.guideline_width)
+
+    def draw_batch(self, bits_12):
+        """Render a batch of tags as grayscale images without cairo.
+
+        Note:
+            The region of every pixel is precomputed once per geometry, all images are then
+            produced with a single gather from a per-tag palette. Unlike :meth:`draw`, edges
+            are not antialiased.
+
+        Arguments:
+            bits_12 (:obj:`np.array`): IDs in bb_binary representation with shape [N, 12]
+
+        Returns:
+            :obj:`np.array`: uint8 images with shape [N, surface_height, surface_width]
+        """
+        palette = _tag_palette(bits_12, int(round(255 * np.mean(self.background_color[:3]))))
+        return palette[:, self._label_map()]
+
+    def draw_mosaic(self, bits_12, n_columns=None, labels=None, path=None, label_height=None,
+                    chunk_size=1024, max_workers=None, parallel_threshold=10000):
+        """Render many tags into one tiled image.
+
+        Note:
+            Tiles are rendered with :meth:`draw_batch` in chunks directly into a preallocated
+            image. For more than `parallel_threshold` tags, chunks are rendered in a thread pool.
+            Labels are drawn with cairo below each tile.
+
+        Arguments:
+            bits_12: IDs in bb_binary representation with shape [N, 12] or a
+                :class:`.BeesbookIDArray`
+            n_columns (:obj:`int`): (optional) number of tiles per row, square layout by default
+            labels ([str]): (optional) text drawn below each tile, e.g. bee names
+            path (:obj:`str`): (optional) the mosaic is written to this PNG file
+            label_height (:obj:`int`): (optional) height of the label strip in pixels
+            chunk_size (:obj:`int`): number of tiles rendered at once
+            max_workers (:obj:`int`): (optional) number of threads for parallel rendering
+            parallel_threshold (:obj:`int`): minimum number of tags for parallel rendering
+
+        Returns:
+            :obj:`np.array`: uint8 grayscale mosaic
+        """
+        if hasattr(bits_12, 'as_bb_binary'):
+            bits_12 = bits_12.as_bb_binary()
+        bits_12 = np.atleast_2d(bits_12)
+        nb_tags = len(bits_12)
+        if labels is not None and len(labels) != nb_tags:
+            raise ValueError('Number of labels does not match number of IDs')
+
+        if n_columns is None:
+            n_columns = max(int(np.ceil(np.sqrt(nb_tags))), 1)
+        n_rows = max(int(np.ceil(nb_tags / n_columns)), 1)
+        if label_height is None:
+            label_height = 0 if labels is None else max(self.surface_height // 8, 10)
+        tile_height = self.surface_height + label_height
+        tile_width = self.surface_width
+
+        background = int(round(255 * np.mean(self.background_color[:3])))
+        mosaic = np.full((n_rows * tile_height, n_columns * tile_width), background,
+                         dtype=np.uint8)
+        tiles = mosaic.reshape(n_rows, tile_height, n_columns, tile_width)
+
+        def render_chunk(start):
+            indices = np.arange(start, min(start + chunk_size, nb_tags))
+            tiles[indices // n_columns, :self.surface_height, indices % n_columns, :] = \
+                self.draw_batch(bits_12[indices])
+
+        starts = range(0, nb_tags, chunk_size)
+        if nb_tags > parallel_threshold:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(render_chunk, starts))
+        else:
+            for start in starts:
+                render_chunk(start)
+
+        if labels is not None:
+            self._draw_mosaic_labels(mosaic, labels, n_columns, tile_height, label_height)
+
+        if path is not None:
+            with open(path, 'wb') as f:
+                f.write(_encode_png(mosaic))
+
+        return mosaic
+
+    def _draw_mosaic_labels(self, mosaic, labels, n_columns, tile_height, label_height):
+        import cairocffi as cairo
+
+        height, width = mosaic.shape
+        surface = cairo.ImageSurface(cairo.FORMAT_A8, width, height)
+        ctx = cairo.Context(surface)
+        ctx.set_font_size(label_height * .8)
+        for idx, label in enumerate(labels):
+            row, column = divmod(idx, n_columns)
+            text = str(label)
+            x_bearing, _, text_width, _, _, _ = ctx.text_extents(text)
+            ctx.move_to((column + .5) * self.surface_width - x_bearing - text_width / 2,
+                        (row + 1) * tile_height - label_height * .2)
+            ctx.show_text(text)
+        surface.flush()
+
+        # the A8 surface holds the text coverage, rows are padded to the surface stride
+        coverage = np.frombuffer(surface.get_data(), dtype=np.uint8)
+        coverage = coverage.reshape(height, surface.get_stride())[:, :width]
+        mosaic[:] = (mosaic.astype(np.uint16) * (255 - coverage) // 255).astype(np.uint8)
+
+    def draw_cached(self, bits_12):
+        """Same as :meth:`draw`, but memoized in a bounded LRU cache.
+
+        Note:
+            The cache is keyed by the ID in dec_12 representation, the surface size, the tag
+            radius, the background color and the guideline width.
+
+        Arguments:
+            bits_12 (:obj:`np.array`): ID in bb_binary representation
+
+        Returns:
+            :obj:`bytes`: PNG image
+        """
+        return _draw_cached(_bits_to_dec_12(bits_12), self.surface_width, self.surface_height,
+                            self.tag_radius, tuple(self.background_color), self.guideline_width)
+
     def draw(self, bits_12):
         import cairocffi as cairo
         
@@ -90,3 +317,133 @@ class TagArtist:
         b.seek(0)
 
         return b.read()
+
+
+class TagAtlas:
+    """Images of all 4096 tags in a single contiguous array indexed by dec_12 ID.
+
+    Note:
+        Atlases can be saved to disk and memory-mapped, displaying a tag is then a slice of the
+        atlas array.
+
+    Arguments:
+        images (:obj:`np.array`): uint8 images with shape [4096, height, width]
+    """
+
+    def __init__(self, images):
+        if len(images) != 4096:
+            raise ValueError('Atlas must contain the images of all 4096 IDs')
+        self.images = images
+
+    @classmethod
+    def build(cls, artist=None):
+        """Render all 4096 tags with :meth:`.TagArtist.draw_batch`.
+
+        Arguments:
+            artist (:class:`.TagArtist`): (optional) artist with the render parameters
+        """
+        artist = TagArtist() if artist is None else artist
+        return cls(artist.draw_batch(_dec_12_to_bits(np.arange(4096))))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load an atlas saved with :meth:`save`, memory-mapped by default."""
+        return cls(np.load(path, mmap_mode=mmap_mode))
+
+    def save(self, path):
+        """Save the atlas as .npy file."""
+        np.save(path, np.ascontiguousarray(self.images))
+
+    def __getitem__(self, dec_12):
+        return self.images[dec_12]
+
+    def draw(self, bits_12):
+        """Return the PNG image of the given ID in bb_binary representation."""
+        return _encode_png(self.images[_bits_to_dec_12(bits_12)])
+
+
+class TagOverlay:
+    """Composites decoded tag crowns into video frames at the detections' positions.
+
+    Note:
+        Label maps of the crown are precomputed for `nb_rotations` orientations. The sprites of
+        all detections of a frame are produced with a single gather and blended into the frame
+        with one fancy-indexed assignment. Where sprites overlap, one of them wins.
+
+    Arguments:
+        sprite_size (:obj:`int`): width and height of the crown sprites in frame pixels
+        nb_rotations (:obj:`int`): number of precomputed orientations
+        alpha (:obj:`float`): opacity of the crowns
+        tag_radius (:obj:`float`): radius of the crown relative to the sprite size
+    """
+
+    def __init__(self, sprite_size=64, nb_rotations=72, alpha=.5, tag_radius=.48):
+        self.sprite_size = sprite_size
+        self.nb_rotations = nb_rotations
+        self.alpha = alpha
+        artist = TagArtist(sprite_size, sprite_size, tag_radius=tag_radius)
+        rotations = np.linspace(0, 2 * np.pi, num=nb_rotations, endpoint=False)
+        self.label_maps = np.stack([
+            _compute_tag_label_map(sprite_size, sprite_size, artist.tag_radius,
+                                   artist.inner_radius, artist.outer_radius,
+                                   artist.guideline_width, rotation)
+            for rotation in rotations])
+
+    def __call__(self, frame, positions, orientations, bits_12, copy=True):
+        """Overlay the crowns of all detections of a frame.
+
+        Arguments:
+            frame (:obj:`np.array`): grayscale [H, W] or color [H, W, C] frame, integer frames
+                are expected in [0, 255], float frames in [0, 1]
+            positions (:obj:`np.array`): [N, 2] (x, y) pixel positions of the tag centers
+            orientations (:obj:`np.array`): [N] orientations in radians, clockwise in image
+                coordinates, 0 means the first bit of the bb_binary representation is up
+            bits_12 (:obj:`np.array`): [N, 12] decoded IDs in bb_binary representation
+            copy (:obj:`bool`): whether to draw on a copy of the frame
+
+        Returns:
+            :obj:`np.array`: frame with the overlayed crowns
+        """
+        frame = np.array(frame, copy=True) if copy else frame
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        if len(positions) == 0:
+            return frame
+
+        rotation_indices = np.round(np.asarray(orientations) /
+                                    (2 * np.pi / self.nb_rotations)).astype(np.int64)
+        label_maps = self.label_maps[rotation_indices % self.nb_rotations]
+        palette = _tag_palette(bits_12, 0)
+        sprites = palette[np.arange(len(palette))[:, None, None], label_maps]
+
+        offsets = np.arange(self.sprite_size) - self.sprite_size // 2
+        rows = np.round(positions[:, 1]).astype(np.int64)[:, None, None] + offsets[None, :, None]
+        columns = np.round(positions[:, 0]).astype(np.int64)[:, None, None] + offsets[None, None, :]
+        visible = (label_maps != _BACKGROUND) & \
+            (rows >= 0) & (rows < frame.shape[0]) & (columns >= 0) & (columns < frame.shape[1])
+        rows, columns = np.broadcast_arrays(rows, columns)
+        rows, columns, sprites = rows[visible], columns[visible], sprites[visible]
+
+        values = sprites.astype(np.float32)
+        if not np.issubdtype(frame.dtype, np.integer):
+            values /= 255.
+        if frame.ndim == 3:
+            values = values[:, None]
+        blended = (1 - self.alpha) * frame[rows, columns] + self.alpha * values
+        if np.issubdtype(frame.dtype, np.integer):
+            blended = np.round(blended)
+        frame[rows, columns] = blended.astype(frame.dtype)
+        return frame
+
+    def stream(self, frames, detections, copy=True):
+        """Lazily overlay the crowns of a stream of frames, e.g. to write a QA video.
+
+        Arguments:
+            frames: iterable of frames
+            detections: iterable of (positions, orientations, bits_12) for each frame
+            copy (:obj:`bool`): whether to draw on copies of the frames
+
+        Returns:
+            generator of frames with the overlayed crowns
+        """
+        for frame, (positions, orientations, bits_12) in zip(frames, detections):
+            yield self(frame, positions, orientations, bits_12, copy=copy)